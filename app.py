@@ -28,15 +28,13 @@ vpc_stack = ImageInsightsVpcStack(app, "ImageInsightsVpc", env=AWS_ENV)
 s3_stack = ImageInsightsS3Stack(app, "ImageInsightsS3")
 s3_stack.add_dependency(vpc_stack)
 
-api_gw_stack = ImageInsightsApiGwStack(app, "ImageInsightsApiGw")
-api_gw_stack.add_dependency(s3_stack)
-
 kds_stack = ImageInsightsKinesisStreamStack(app, "ImageInsightsKinesisStream")
 kds_stack.add_dependency(vpc_stack)
 
 image_tagger_trigger_lambda = ImageTaggerTriggerLambdaStack(app,
   "ImageInsightsImageTaggerTriggerLambda",
-  kds_stack.kinesis_stream
+  kds_stack.kinesis_stream,
+  kds_stack.dead_letter_queue
 )
 image_tagger_trigger_lambda.add_dependency(kds_stack)
 
@@ -69,6 +67,17 @@ image_tag_search_stack = ImageInsightsOpenSearchStack(app,
 # )
 image_tag_search_stack.add_dependency(bastion_host)
 
+api_gw_stack = ImageInsightsApiGwStack(app, "ImageInsightsApiGw",
+  vpc_stack.vpc,
+  image_tag_search_stack.search_domain_endpoint,
+  image_tag_search_stack.search_domain_arn,
+  image_tag_search_stack.sg_search_client,
+  image_bucket=s3_stack.s3_input_bucket,
+  env=AWS_ENV
+)
+api_gw_stack.add_dependency(s3_stack)
+api_gw_stack.add_dependency(image_tag_search_stack)
+
 image_tagger_lambda = ImageTaggerLambdaStack(app,
   "ImageInsightsImageTaggerLambda",
   vpc_stack.vpc,
@@ -76,6 +85,7 @@ image_tagger_lambda = ImageTaggerLambdaStack(app,
   image_tag_search_stack.search_domain_arn,
   image_tag_search_stack.sg_search_client,
   kds_stack.kinesis_stream,
+  kds_stack.dead_letter_queue,
   env=AWS_ENV
 )
 image_tagger_lambda.add_dependency(image_tag_search_stack)
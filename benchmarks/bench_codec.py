@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Compare the JSON backends of `json_codec` on the hot paths of the handlers.
+
+For batches of 100 and 10k records it times:
+  - kinesis_payloads: encoding the trigger's {s3_bucket, s3_key} messages
+  - bulk_body: building the NDJSON bulk body of the tagger's documents
+  - decode_messages: decoding the messages in the tagger
+
+orjson is only measured when it is installed.
+
+  $ python benchmarks/bench_codec.py --batch-size 100 --batch-size 10000
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src', 'main', 'python', 'CommonLib', 'python'))
+
+import json_codec
+import stubs
+
+
+def _backends():
+  backends = {'json': (json_codec._stdlib_dumps, json_codec._stdlib_loads)}
+  if json_codec.orjson is not None:
+    backends['orjson'] = (json_codec.orjson.dumps, json_codec.orjson.loads)
+  return backends
+
+
+def _sample_doc(i):
+  return {
+    'doc_id': '{:064x}'.format(i),
+    'image_id': 'img-{:06}.jpg'.format(i),
+    'image_url': 'https://november-photo.s3.amazonaws.com/raw-image/img-{:06}.jpg'.format(i),
+    'tags': sorted(label['Name'] for label in stubs.SAMPLE_LABELS),
+    'tag_id': '{:08x}'.format(i),
+    'created_at': datetime.datetime(2020, 11, 18, 9, 18, 59).strftime('%Y-%m-%dT%H:%M:%SZ')
+  }
+
+
+def run(batch_size, number):
+  messages = [{'s3_bucket': 'november-photo', 's3_key': 'raw-image/사진-{:06}.jpg'.format(i),
+    's3_etag': '{:032x}'.format(i)} for i in range(batch_size)]
+  actions = [({'index': {'_index': 'image_insights', '_id': '{:064x}'.format(i)}}, _sample_doc(i))
+    for i in range(batch_size)]
+  encoded = [json.dumps(message).encode('utf-8') for message in messages]
+
+  results = []
+  for name, (dumps, loads) in _backends().items():
+    cases = {
+      'kinesis_payloads': lambda: [dumps(message) for message in messages],
+      'bulk_body': lambda: b''.join(dumps(meta) + b'\n' + dumps(doc) + b'\n' for meta, doc in actions),
+      'decode_messages': lambda: [loads(data) for data in encoded]
+    }
+    for case, fn in cases.items():
+      best = min(timeit.repeat(fn, number=number, repeat=5)) / number
+      results.append({'backend': name, 'case': case, 'batch_size': batch_size,
+        'ms_per_batch': round(best * 1000, 4), 'us_per_record': round(best * 1e6 / batch_size, 3)})
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--batch-size', type=int, action='append')
+  options = parser.parse_args()
+
+  if json_codec.orjson is None:
+    print('[WARN] orjson is not installed, measuring the stdlib backend only', file=sys.stderr)
+  for batch_size in options.batch_size or [100, 10000]:
+    for result in run(batch_size, number=max(1, 20000 // batch_size)):
+      print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+  main()
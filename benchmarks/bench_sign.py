@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Compare the per-signature cost and the API requests of an upload session in SignS3Post.
+
+  - per_signature: signing one policy with the SigV4 key derived on every call
+    (before) and with the cached key (after)
+  - session: signing the policies of an upload session of N files one request
+    per file (before) and in batches of --batch-size (after), with --latency-ms
+    of API Gateway round trip per request
+
+  $ python benchmarks/bench_sign.py --files 300 --batch-size 100 --latency-ms 40
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src', 'main', 'python', 'SignS3Post'))
+
+import sign_s3_post
+import stubs
+
+SECRET_KEY = 'wJalrXUtnFEMI/K7MDENG/bPxRfiCYEXAMPLEKEY'
+
+
+def _per_signature_us(number):
+  events = [stubs.sign_policy_event(i) for i in range(100)]
+  derive_key = sign_s3_post.getSignatureKey
+
+  def sign_all():
+    for event in events:
+      sign_s3_post.sign_request(event)
+
+  results = {}
+  for name, key_fn in (('uncached', derive_key.__wrapped__), ('cached', derive_key)):
+    sign_s3_post.getSignatureKey = key_fn
+    try:
+      best = min(timeit.repeat(sign_all, number=number, repeat=5)) / number
+    finally:
+      sign_s3_post.getSignatureKey = derive_key
+    results[name] = round(best * 1e6 / len(events), 2)
+  return results
+
+
+def _session(files, batch_size, latency_ms):
+  events = [stubs.sign_policy_event(i) for i in range(files)]
+
+  def single():
+    for event in events:
+      sign_s3_post.lambda_handler(event, {})
+
+  def batched():
+    for i in range(0, files, batch_size):
+      sign_s3_post.lambda_handler({'batch': events[i:i + batch_size]}, {})
+
+  requests = {'single': files, 'batch': math.ceil(files / batch_size)}
+  results = {}
+  for name, fn in (('single', single), ('batch', batched)):
+    compute_ms = min(timeit.repeat(fn, number=1, repeat=5)) * 1000
+    results[name] = {
+      'requests': requests[name],
+      'compute_ms': round(compute_ms, 3),
+      'estimated_session_ms': round(compute_ms + requests[name] * latency_ms, 1)
+    }
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--files', type=int, default=300, help='files uploaded in a session')
+  parser.add_argument('--batch-size', type=int, default=100)
+  parser.add_argument('--latency-ms', type=float, default=40.0, help='round trip of one API request')
+  options = parser.parse_args()
+
+  logging.getLogger().setLevel(logging.WARNING)
+  sign_s3_post.SECRET_KEY = SECRET_KEY
+
+  print(json.dumps({'case': 'per_signature_us', **_per_signature_us(number=20)}))
+  print(json.dumps({'case': 'session', 'files': options.files, 'batch_size': options.batch_size,
+    'latency_ms': options.latency_ms, **_session(options.files, options.batch_size, options.latency_ms)}))
+
+
+if __name__ == '__main__':
+  main()
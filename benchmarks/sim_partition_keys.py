@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Simulate how the trigger's messages spread over the shards of the stream.
+
+Shards split the 128-bit hash key space evenly, as a freshly created ON_DEMAND
+stream does. Every synthetic S3 event carries `--event-size` objects. The old
+scheme re-seeded `random` with 47 on every invocation, and the new one hashes
+bucket/key (and, with KPL aggregation, routes every slice of the hash key space
+through one explicit hash key).
+
+  $ python benchmarks/sim_partition_keys.py --keys 100000 --shards 4 --shards 16
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import statistics
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..', 'src', 'main', 'python')
+sys.path.insert(0, os.path.join(SRC_DIR, 'TriggerImageAutoTagger'))
+sys.path.insert(0, os.path.join(SRC_DIR, 'CommonLib', 'python'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import trigger_image_auto_tagger as trigger
+
+HASH_KEY_SPACE = 2 ** 128
+
+
+def shard_of(hash_key, n_shards):
+  return hash_key * n_shards // HASH_KEY_SPACE
+
+
+def md5_hash_key(partition_key):
+  return int(hashlib.md5(partition_key.encode('utf-8')).hexdigest(), 16)
+
+
+def seeded_random_keys(n_keys, event_size):
+  """The partition keys of the old trigger, which called random.seed(47) for every event."""
+  keys = []
+  rng = random.Random()
+  while len(keys) < n_keys:
+    rng.seed(47)
+    keys.extend('part-{:05}'.format(rng.randint(1, 1024)) for _ in range(min(event_size, n_keys - len(keys))))
+  return [md5_hash_key(key) for key in keys]
+
+
+def object_hash_keys(records, aggregation):
+  if aggregation:
+    return [int(trigger._explicit_hash_key(trigger._hash_key_slice(trigger.partition_key(rec)))) for rec in records]
+  return [md5_hash_key(trigger.partition_key(rec)) for rec in records]
+
+
+def distribution(hash_keys, n_shards):
+  counts = [0] * n_shards
+  for hash_key in hash_keys:
+    counts[shard_of(hash_key, n_shards)] += 1
+  mean = len(hash_keys) / n_shards
+  return {
+    'per_shard': counts,
+    'max_over_mean': round(max(counts) / mean, 3),
+    'stdev_over_mean': round(statistics.pstdev(counts) / mean, 4)
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--keys', type=int, default=100000)
+  parser.add_argument('--shards', type=int, action='append')
+  parser.add_argument('--event-size', type=int, default=1, help='objects per S3 event')
+  options = parser.parse_args()
+
+  records = [{'s3_bucket': 'november-photo', 's3_key': 'raw-image/{:04}/IMG_{:08}.jpg'.format(i % 977, i)}
+    for i in range(options.keys)]
+  schemes = {
+    'seeded_random': seeded_random_keys(options.keys, options.event_size),
+    'object_hash': object_hash_keys(records, aggregation=False),
+    'object_hash_aggregated': object_hash_keys(records, aggregation=True)
+  }
+  for n_shards in options.shards or [4, 16]:
+    for name, hash_keys in schemes.items():
+      print(json.dumps(dict(scheme=name, shards=n_shards, keys=options.keys, **distribution(hash_keys, n_shards))))
+
+
+if __name__ == '__main__':
+  main()
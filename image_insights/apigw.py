@@ -9,13 +9,15 @@ from aws_cdk import (
   aws_iam,
   aws_lambda as _lambda,
   aws_logs,
+  aws_s3 as s3,
 )
 from constructs import Construct
 
 
 class ImageInsightsApiGwStack(Stack):
 
-  def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+  def __init__(self, scope: Construct, construct_id: str, vpc=None, search_domain_endpoint=None,
+      search_domain_arn=None, sg_search_client=None, image_bucket=None, **kwargs) -> None:
     super().__init__(scope, construct_id, **kwargs)
 
     s3_access_key_id = self.node.try_get_context('s3_access_key_id')
@@ -28,7 +30,11 @@ class ImageInsightsApiGwStack(Stack):
       code=_lambda.Code.from_asset("./src/main/python/SignS3Post"),
       environment={
         'ACCESS_KEY': s3_access_key_id,
-        'SECRET_KEY': s3_secret_key
+        'SECRET_KEY': s3_secret_key,
+        'PRESIGNED_URL_EXPIRES_IN': '3600',
+        #XXX: the multipart routes are not authenticated, so they only sign uploads of new images
+        'ALLOWED_BUCKETS': image_bucket.bucket_name if image_bucket else '',
+        'ALLOWED_KEY_PREFIX': 'raw-image/'
       },
       timeout=cdk.Duration.minutes(5)
     )
@@ -127,6 +133,7 @@ class ImageInsightsApiGwStack(Stack):
       ],
     )
     self.add_cors_options(api.root)
+    self.add_multipart_routes(api, sign_s3_post_lambda_fn)
 
     get_s3_folder_integration_options = apigw.IntegrationOptions(
       credentials_role=rest_api_role,
@@ -245,9 +252,126 @@ class ImageInsightsApiGwStack(Stack):
       }
     )
 
+    if search_domain_endpoint is not None:
+      self.add_tag_search_routes(api, vpc, search_domain_endpoint, search_domain_arn, sg_search_client)
+
     cdk.CfnOutput(self, '{self.stack_name}_ApiEndpoint', value=api.url)
 
 
+  def add_tag_search_routes(self, api, vpc, search_domain_endpoint, search_domain_arn, sg_search_client):
+    ES_INDEX_NAME = 'image_insights'
+
+    s3_lib_bucket_name = self.node.try_get_context('lib_bucket_name')
+    s3_lib_bucket = s3.Bucket.from_bucket_name(self, "LibBucket", s3_lib_bucket_name)
+    es_lib_layer = _lambda.LayerVersion(self, "ESLib",
+      compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+      code=_lambda.Code.from_bucket(s3_lib_bucket, "var/es-lib.zip")
+    )
+    common_lib_layer = _lambda.LayerVersion(self, "CommonLib",
+      compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+      code=_lambda.Code.from_asset("./src/main/python/CommonLib")
+    )
+
+    tag_search_lambda_fn = _lambda.Function(self, "ImageTagSearch",
+      runtime=_lambda.Runtime.PYTHON_3_7,
+      function_name="ImageTagSearch",
+      handler="image_tag_search.lambda_handler",
+      description="Search images by tags and aggregate the top tags",
+      code=_lambda.Code.from_asset("./src/main/python/ImageTagSearch"),
+      environment={
+        'ES_HOST': search_domain_endpoint,
+        'ES_INDEX': ES_INDEX_NAME,
+        'QUERY_CACHE_SIZE': '256',
+        'QUERY_CACHE_TTL_SECONDS': '60',
+        'GENERATION_CHECK_SECONDS': '5',
+        'METRICS_NAMESPACE': 'ImageInsights'
+      },
+      timeout=cdk.Duration.seconds(29),
+      memory_size=256,
+      layers=[es_lib_layer, common_lib_layer],
+      security_groups=[sg_search_client],
+      vpc=vpc
+    )
+
+    tag_search_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[f"{search_domain_arn}/{ES_INDEX_NAME}*"],
+      actions=["es:ESHttpGet", "es:ESHttpPost"]
+    ))
+
+    log_group = aws_logs.LogGroup(self, "ImageTagSearchLogGroup",
+      log_group_name="/aws/lambda/ImageTagSearch",
+      removal_policy=cdk.RemovalPolicy.DESTROY, #XXX: for testing
+      retention=aws_logs.RetentionDays.THREE_DAYS)
+    log_group.grant_write(tag_search_lambda_fn)
+
+    #XXX: S3 bucket names can not start with '_', so these do not shadow the /{folder} routes
+    tag_search_integration = apigw.LambdaIntegration(tag_search_lambda_fn, proxy=True)
+    search_resource = api.root.add_resource('_search')
+    for path in ('tags', 'top-tags'):
+      search_resource.add_resource(path).add_method('GET', tag_search_integration,
+        authorization_type=apigw.AuthorizationType.IAM,
+        api_key_required=False,
+        request_parameters={
+          'method.request.querystring.tags': False,
+          'method.request.querystring.since': False,
+          'method.request.querystring.size': False
+        }
+      )
+
+    cdk.CfnOutput(self, f'{self.stack_name}_TagSearchLambdaRoleArn', value=tag_search_lambda_fn.role.role_arn)
+
+
+  def add_multipart_routes(self, api, sign_s3_post_lambda_fn):
+    #XXX: S3 bucket names can not start with '_', so these do not shadow the /{folder} routes
+    multipart_resource = api.root.add_resource('_multipart')
+    for action in ('initiate', 'sign-parts', 'complete', 'abort'):
+      multipart_integration = apigw.LambdaIntegration(sign_s3_post_lambda_fn,
+        proxy=False,
+        request_templates={
+          'application/json': '{"multipart_action": "%s", "body": $input.json(\'$\')}' % action
+        },
+        integration_responses=[{
+          'statusCode': '200',
+          'responseParameters': {
+            'method.response.header.Access-Control-Allow-Origin': "'*'",
+          }
+        }, {
+          # sign_s3_post.BadRequestError
+          'statusCode': '400',
+          'selectionPattern': r'\[BadRequest\].*',
+          'responseParameters': {
+            'method.response.header.Access-Control-Allow-Origin': "'*'",
+          },
+          'responseTemplates': {
+            'application/json': '{"message": $input.json(\'$.errorMessage\')}'
+          }
+        }]
+      )
+
+      action_resource = multipart_resource.add_resource(action)
+      action_resource.add_method('POST',
+        multipart_integration,
+        method_responses=[apigw.MethodResponse(status_code="200",
+            response_parameters={
+              'method.response.header.Content-Type': False,
+              'method.response.header.Access-Control-Allow-Origin': True
+            },
+            response_models={
+              'application/json': apigw.Model.EMPTY_MODEL
+            }
+          ),
+          apigw.MethodResponse(status_code="400",
+            response_parameters={
+              'method.response.header.Access-Control-Allow-Origin': True
+            }
+          ),
+          apigw.MethodResponse(status_code="500")
+        ],
+      )
+      self.add_cors_options(action_resource)
+
+
   def add_cors_options(self, apigw_resource):
     apigw_resource.add_method('OPTIONS', apigw.MockIntegration(
         integration_responses=[{
@@ -6,6 +6,7 @@ import aws_cdk as cdk
 from aws_cdk import (
   Stack,
   aws_s3 as s3,
+  aws_dynamodb,
   aws_iam,
   aws_lambda as _lambda,
   aws_logs
@@ -13,13 +14,14 @@ from aws_cdk import (
 from constructs import Construct
 
 from aws_cdk.aws_lambda_event_sources import (
-  KinesisEventSource
+  KinesisEventSource,
+  SqsDlq
 )
 
 
 class ImageTaggerLambdaStack(Stack):
 
-  def __init__(self, scope: Construct, construct_id: str, vpc, search_domain_endpoint, search_domain_arn, sg_search_client, img_kinesis_stream, **kwargs) -> None:
+  def __init__(self, scope: Construct, construct_id: str, vpc, search_domain_endpoint, search_domain_arn, sg_search_client, img_kinesis_stream, dead_letter_queue=None, **kwargs) -> None:
     super().__init__(scope, construct_id, **kwargs)
 
     #XXX: https://github.com/aws/aws-cdk/issues/1342
@@ -31,8 +33,21 @@ class ImageTaggerLambdaStack(Stack):
       code=_lambda.Code.from_bucket(s3_lib_bucket, "var/es-lib.zip")
     )
 
+    common_lib_layer = _lambda.LayerVersion(self, "CommonLib",
+      compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+      code=_lambda.Code.from_asset("./src/main/python/CommonLib")
+    )
+
+    #XXX: shared tier of the content-addressed label cache in the image tagger
+    label_cache_table = aws_dynamodb.Table(self, "ImageLabelCache",
+      table_name="ImageLabelCache",
+      partition_key=aws_dynamodb.Attribute(name="cache_key", type=aws_dynamodb.AttributeType.STRING),
+      billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+      time_to_live_attribute="expire_at",
+      removal_policy=cdk.RemovalPolicy.DESTROY #XXX: for testing
+    )
+
     ES_INDEX_NAME = 'image_insights'
-    ES_TYPE_NAME = 'photo'
 
     #XXX: Deploy lambda in VPC - https://github.com/aws/aws-cdk/issues/1342
     auto_img_tagger_lambda_fn = _lambda.Function(self, "AutomaticImageTagger",
@@ -45,10 +60,36 @@ class ImageTaggerLambdaStack(Stack):
         # 'ES_HOST': es_cfn_domain.attr_domain_endpoint,
         'ES_HOST': search_domain_endpoint,
         'ES_INDEX': ES_INDEX_NAME,
-        'ES_TYPE': ES_TYPE_NAME
+        'INDEX_SHARDS': '2',
+        'INDEX_REPLICAS': '1',
+        'INDEX_REFRESH_INTERVAL': '30s',
+        'INDEX_ROLLOVER_MAX_AGE': '30d',
+        'INDEX_ROLLOVER_MAX_SIZE': '50gb',
+        'ROLLUP_GRANULARITIES': 'minute,hour,day',
+        'REKOGNITION_MAX_WORKERS': '10',
+        'REKOGNITION_MAX_TPS': '50',
+        #XXX: any of labels,text,moderation,faces
+        'DETECTORS': 'labels',
+        'MAX_LABELS': '10',
+        'MIN_CONFIDENCE': '55',
+        'DEADLINE_MARGIN_MS': '30000',
+        'PREPROCESS_IMAGES': 'true',
+        'PREPROCESS_MAX_EDGE': '1920',
+        'NEAR_DUP_ENABLED': 'true',
+        'NEAR_DUP_RADIUS': '6',
+        'METRICS_NAMESPACE': 'ImageInsights',
+        'VERBOSE_LOG_SAMPLE_RATE': '0.01',
+        'LABEL_CACHE_SIZE': '1024',
+        'LABEL_CACHE_TABLE': label_cache_table.table_name,
+        'BULK_MAX_CHUNK_DOCS': '500',
+        'BULK_MAX_CHUNK_BYTES': str(5 * 1024 * 1024),
+        'BULK_MAX_RETRIES': '3',
+        'DEAD_LETTER_SPOOL': dead_letter_queue.queue_url if dead_letter_queue else ''
       },
       timeout=cdk.Duration.minutes(5),
-      layers=[es_lib_layer],
+      #XXX: decoding large images on several worker threads needs more than the default 128 MB
+      memory_size=1024,
+      layers=[es_lib_layer, common_lib_layer],
       security_groups=[sg_search_client],
       vpc=vpc
     )
@@ -63,7 +104,21 @@ class ImageTaggerLambdaStack(Stack):
       resources=["*"],
       actions=["s3:Get*", "s3:List*"]))
 
-    img_kinesis_event_source = KinesisEventSource(img_kinesis_stream, batch_size=100, starting_position=_lambda.StartingPosition.LATEST)
+    label_cache_table.grant_read_write_data(auto_img_tagger_lambda_fn)
+    if dead_letter_queue is not None:
+      dead_letter_queue.grant_send_messages(auto_img_tagger_lambda_fn)
+
+    img_kinesis_event_source = KinesisEventSource(img_kinesis_stream,
+      batch_size=100,
+      starting_position=_lambda.StartingPosition.LATEST,
+      # the function returns the failed records as batchItemFailures
+      report_batch_item_failures=True,
+      bisect_batch_on_error=True,
+      retry_attempts=3,
+      #XXX: the shard and sequence numbers of the records still failing after the retries,
+      # which Backfill/replay.py reads back from the stream
+      on_failure=SqsDlq(dead_letter_queue) if dead_letter_queue is not None else None
+    )
     auto_img_tagger_lambda_fn.add_event_source(img_kinesis_event_source)
 
     auto_img_tagger_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
@@ -73,7 +128,11 @@ class ImageTaggerLambdaStack(Stack):
         "es:DescribeElasticsearchDomains",
         "es:DescribeElasticsearchDomainConfig",
         "es:ESHttpPost",
-        "es:ESHttpPut"]
+        "es:ESHttpPut",
+        #XXX: checks whether the write alias of the index exists
+        "es:ESHttpHead",
+        #XXX: clears the scroll context of the near-duplicate index rebuild
+        "es:ESHttpDelete"]
     ))
 
     auto_img_tagger_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
@@ -83,7 +142,7 @@ class ImageTaggerLambdaStack(Stack):
         search_domain_arn,
         f"{search_domain_arn}/_all/_settings",
         f"{search_domain_arn}/_cluster/stats",
-        f"{search_domain_arn}/{ES_INDEX_NAME}*/_mapping/{ES_TYPE_NAME}",
+        f"{search_domain_arn}/{ES_INDEX_NAME}*/_mapping",
         f"{search_domain_arn}/_nodes",
         f"{search_domain_arn}/_nodes/stats",
         f"{search_domain_arn}/_nodes/*/stats",
@@ -18,9 +18,14 @@ from aws_cdk.aws_lambda_event_sources import (
 
 class ImageTaggerTriggerLambdaStack(Stack):
 
-  def __init__(self, scope: Construct, construct_id: str, img_kinesis_stream, **kwargs) -> None:
+  def __init__(self, scope: Construct, construct_id: str, img_kinesis_stream, dead_letter_queue=None, **kwargs) -> None:
     super().__init__(scope, construct_id, **kwargs)
 
+    common_lib_layer = _lambda.LayerVersion(self, "CommonLib",
+      compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+      code=_lambda.Code.from_asset("./src/main/python/CommonLib")
+    )
+
     # create lambda function
     trigger_img_tagger_lambda_fn = _lambda.Function(self, "TriggerImageAutoTagger",
       runtime=_lambda.Runtime.PYTHON_3_7,
@@ -30,9 +35,16 @@ class ImageTaggerTriggerLambdaStack(Stack):
       code=_lambda.Code.from_asset("./src/main/python/TriggerImageAutoTagger"),
       environment={
         'REGION_NAME': cdk.Aws.REGION,
-        'KINESIS_STREAM_NAME': img_kinesis_stream.stream_name
+        'KINESIS_STREAM_NAME': img_kinesis_stream.stream_name,
+        'METRICS_NAMESPACE': 'ImageInsights',
+        'VERBOSE_LOG_SAMPLE_RATE': '0.01',
+        'KPL_AGGREGATION': 'true',
+        'KINESIS_MAX_ATTEMPTS': '5',
+        'KINESIS_HASH_KEY_SLICES': '256',
+        'DEAD_LETTER_SPOOL': dead_letter_queue.queue_url if dead_letter_queue else ''
       },
-      timeout=cdk.Duration.minutes(5)
+      timeout=cdk.Duration.minutes(5),
+      layers=[common_lib_layer]
     )
 
     trigger_img_tagger_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
@@ -46,6 +58,9 @@ class ImageTaggerTriggerLambdaStack(Stack):
       ]
     ))
 
+    if dead_letter_queue is not None:
+      dead_letter_queue.grant_send_messages(trigger_img_tagger_lambda_fn)
+
     #XXX: https://github.com/aws/aws-cdk/issues/2240
     # To avoid to create extra Lambda Functions with names like LogRetentionaae0aa3c5b4d4f87b02d85b201efdd8a
     # if log_retention=aws_logs.RetentionDays.THREE_DAYS is added to the constructor props
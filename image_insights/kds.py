@@ -5,7 +5,8 @@ import aws_cdk as cdk
 
 from aws_cdk import (
   Stack,
-  aws_kinesis as kinesis
+  aws_kinesis as kinesis,
+  aws_sqs as sqs
 )
 from constructs import Construct
 
@@ -23,6 +24,14 @@ class ImageInsightsKinesisStreamStack(Stack):
 
     self.kinesis_stream = img_kinesis_stream
 
+    #XXX: the records the trigger and the image tagger failed, to be replayed with Backfill/replay.py
+    self.dead_letter_queue = sqs.Queue(self, "ImageInsightsDeadLetters",
+      queue_name="image-insights-dead-letters",
+      retention_period=cdk.Duration.days(14),
+      visibility_timeout=cdk.Duration.minutes(15))
+
     cdk.CfnOutput(self, '{self.stack_name}_KinesisStreamArn',
       value=self.kinesis_stream.stream_arn)
+    cdk.CfnOutput(self, '{self.stack_name}_DeadLetterQueueUrl',
+      value=self.dead_letter_queue.queue_url)
 
@@ -19,12 +19,18 @@ class ImageInsightsS3Stack(Stack):
     s3_bucket = s3.Bucket(self, "s3bucket",
       bucket_name="image-insights-{region}-{suffix}".format(region=cdk.Aws.REGION, suffix=s3_image_bucket_name_suffix))
 
-    s3_bucket.add_cors_rule(allowed_methods=[s3.HttpMethods.GET, s3.HttpMethods.POST],
+    s3_bucket.add_cors_rule(allowed_methods=[s3.HttpMethods.GET, s3.HttpMethods.POST, s3.HttpMethods.PUT],
       allowed_origins=['*'],
-      allowed_headers=['Authorization'],
+      allowed_headers=['Authorization', 'Content-Type'],
+      #XXX: the browser reads the ETag of every part it uploads to complete a multipart upload
+      exposed_headers=['ETag'],
       max_age=3000
     )
 
+    #XXX: the parts of multipart uploads that were never completed or aborted are billed until removed
+    s3_bucket.add_lifecycle_rule(id='AbortIncompleteMultipartUpload',
+      abort_incomplete_multipart_upload_after=cdk.Duration.days(1))
+
     self.s3_input_bucket = s3_bucket
 
     cdk.CfnOutput(self, 'ImageRepository', value=self.s3_input_bucket.bucket_name)
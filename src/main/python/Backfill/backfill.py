@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Re-tag the images already in the bucket by feeding their keys into the Kinesis stream.
+
+Only new `ObjectCreated` events reach the image tagger; after changing DETECTORS or
+the thresholds, this sends the existing objects through the same pipeline.
+
+  $ python src/main/python/Backfill/backfill.py --bucket image-insights-us-east-1-xxxx \\
+      --stream-name image-insights --rate 200 --checkpoint backfill.json
+  $ python src/main/python/Backfill/backfill.py --stream-name image-insights \\
+      --inventory-manifest s3://inventory-bucket/image-insights/daily/2020-11-18T00-00Z/manifest.json
+
+The keys are listed in parallel over key ranges split at --split-chars after --prefix
+(or read from the CSV files of an S3 Inventory report), and written with the
+trigger's `put_records`, at most --rate records/s. The progress of every key range
+(inventory file) is saved to --checkpoint, so that running the same command again
+resumes where it stopped. With --dry-run (or DRY_RUN=true) the records are only logged.
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import gzip
+import io
+import itertools
+import json
+import os
+import queue
+import string
+import sys
+import threading
+import time
+import urllib.parse
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for _dir in (os.path.join('CommonLib', 'python'), 'TriggerImageAutoTagger'):
+  sys.path.insert(0, os.path.join(SRC_DIR, _dir))
+
+import boto3
+from botocore.config import Config
+
+import trigger_image_auto_tagger
+
+#XXX: the same objects the S3 event notifications of the image tagger trigger send
+DEFAULT_PREFIX = 'raw-image/'
+DEFAULT_SUFFIXES = '.jpeg,png'
+DEFAULT_SPLIT_CHARS = string.digits + string.ascii_letters
+
+QUEUE_PAGES = 64
+
+
+def key_range_bounds(prefix, split_chars, depth=1):
+  """Return the sorted bounds that split the keys under the prefix into ranges (b_i, b_i+1]."""
+  chars = sorted(set(split_chars))
+  return [prefix + ''.join(chars) for chars in itertools.product(chars, repeat=depth)]
+
+
+def key_ranges(bounds):
+  """Return (start_after, end) of every range; the first one has no start and the last one no end."""
+  return list(zip([None] + bounds, bounds + [None]))
+
+
+def _wanted(key, prefix, suffixes):
+  return key.startswith(prefix) and key.endswith(suffixes) and not key.endswith('/')
+
+
+def _record(bucket, key, etag, size=None):
+  record = {'s3_bucket': bucket, 's3_key': key}
+  if etag:
+    # the same form as the eTag of an S3 event, for the label cache of the image tagger
+    record['s3_etag'] = etag.strip('"')
+  if size not in (None, ''):
+    # the same as the size of an S3 event, for the size limits of the image tagger
+    record['s3_size'] = int(size)
+  return record
+
+
+def list_key_range(s3_client, bucket, prefix, suffixes, start_after, end, page_size=1000):
+  """Yield (records, last_key) of every page of the keys in (start_after, end] under the prefix."""
+  kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': page_size}
+  if start_after is not None and start_after >= prefix:
+    kwargs['StartAfter'] = start_after
+  for page in s3_client.get_paginator('list_objects_v2').paginate(**kwargs):
+    objects = page.get('Contents', [])
+    past_end = end is not None and objects and objects[-1]['Key'] > end
+    if past_end:
+      objects = [obj for obj in objects if obj['Key'] <= end]
+    if objects:
+      records = [_record(bucket, obj['Key'], obj.get('ETag'), obj.get('Size')) for obj in objects
+        if _wanted(obj['Key'], prefix, suffixes)]
+      yield (records, objects[-1]['Key'])
+    if past_end:
+      return
+
+
+def read_inventory_manifest(s3_client, manifest_url):
+  """Return (bucket of the report files, manifest) of an s3://bucket/key/manifest.json of S3 Inventory."""
+  url = urllib.parse.urlsplit(manifest_url)
+  manifest = json.load(s3_client.get_object(Bucket=url.netloc, Key=url.path.lstrip('/'))['Body'])
+  if manifest.get('fileFormat', 'CSV') != 'CSV':
+    raise ValueError('only CSV inventory reports are supported, not {}'.format(manifest['fileFormat']))
+  return (url.netloc, manifest)
+
+
+def read_inventory_file(s3_client, bucket, key, schema, prefix, suffixes, skip_rows=0, page_size=1000):
+  """Yield (records, rows_read) of every page of the rows of an inventory CSV file after skip_rows."""
+  columns = [column.strip() for column in schema.split(',')]
+  body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+  rows = csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(body)), encoding='utf-8'))
+
+  records, rows_read = [], 0
+  for rows_read, row in enumerate(itertools.islice(rows, skip_rows, None), start=skip_rows + 1):
+    item = dict(zip(columns, row))
+    # the keys of an inventory report are URL-encoded
+    object_key = urllib.parse.unquote_plus(item['Key'], encoding='utf-8')
+    if _wanted(object_key, prefix, suffixes):
+      records.append(_record(item['Bucket'], object_key, item.get('ETag'), item.get('Size')))
+    if rows_read % page_size == 0:
+      yield (records, rows_read)
+      records = []
+  if rows_read % page_size:
+    yield (records, rows_read)
+
+
+class Checkpoint:
+  """Progress of a backfill, saved as JSON: the position of every partition and the records to resend."""
+
+  def __init__(self, path, source, enabled=True):
+    self.path = path
+    self.enabled = enabled and bool(path)
+    self.state = {'source': source, 'partitions': {}, 'unwritten': [], 'written': 0}
+    if path and os.path.exists(path):
+      with open(path) as f:
+        state = json.load(f)
+      if state['source'] != source:
+        raise SystemExit('[ERROR] {} is the checkpoint of another backfill: {}'.format(path, state['source']))
+      self.state = state
+
+  def partition(self, partition_id):
+    return self.state['partitions'].setdefault(partition_id, {'position': None, 'done': False})
+
+  def save(self):
+    if not self.enabled:
+      return
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self.state, f)
+    os.replace(tmp_path, self.path)
+
+
+class RecordWriter:
+  """Write records into the stream with the trigger's `put_records`, at no more than `rate` records/s."""
+
+  def __init__(self, kinesis_client, stream_name, rate, batch_size=500, clock=time.monotonic, sleep=time.sleep):
+    self.kinesis_client = kinesis_client
+    self.stream_name = stream_name
+    self.rate = rate
+    self.batch_size = batch_size
+    self._clock = clock
+    self._sleep = sleep
+    self._allowed_at = clock()
+    self.written = 0
+    self.unwritten = 0
+
+  def put(self, records):
+    """Write the records in batches, and return the unwritten ones."""
+    unwritten = []
+    for i in range(0, len(records), self.batch_size):
+      batch = records[i:i + self.batch_size]
+      if self.rate:
+        wait = self._allowed_at - self._clock()
+        if wait > 0:
+          self._sleep(wait)
+        self._allowed_at = max(self._allowed_at, self._clock()) + len(batch) / self.rate
+      failed = trigger_image_auto_tagger.put_records(self.kinesis_client, self.stream_name, batch)
+      for record in failed:
+        print('[ERROR] Failed to put_records into kinesis stream: {}'.format(self.stream_name),
+          json.dumps(record, ensure_ascii=False), file=sys.stderr)
+      self.written += len(batch) - len(failed)
+      self.unwritten += len(failed)
+      unwritten.extend(failed)
+    return unwritten
+
+
+class Backfill:
+
+  def __init__(self, writer, checkpoint, workers=8, progress_seconds=10.0, max_records=None,
+      clock=time.monotonic):
+    self.writer = writer
+    self.checkpoint = checkpoint
+    self.workers = workers
+    self.progress_seconds = progress_seconds
+    self.max_records = max_records
+    self._clock = clock
+    self._stop = threading.Event()
+    self.stats = {'listed': 0, 'partitions_done': 0}
+
+  def _put(self, records):
+    return self.writer.put(records)
+
+  def _offer(self, pages, item):
+    """Put the item into the queue unless the backfill stopped, and return whether it did."""
+    while not self._stop.is_set():
+      try:
+        pages.put(item, timeout=0.5)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _produce(self, pages, partition_id, read_pages):
+    try:
+      for records, position in read_pages():
+        if not self._offer(pages, ('page', partition_id, records, position)):
+          return
+      self._offer(pages, ('done', partition_id, None, None))
+    except Exception as ex:
+      self._offer(pages, ('error', partition_id, ex, None))
+
+  def run(self, partitions):
+    """Feed the records of the partitions, a dict of partition id to a function (position -> pages)."""
+    state = self.checkpoint.state
+    if state['unwritten']:
+      print('[INFO] resending {} records unwritten by the last run'.format(len(state['unwritten'])), file=sys.stderr)
+      written_before = self.writer.written
+      state['unwritten'] = self._put(state['unwritten'])
+      state['written'] += self.writer.written - written_before
+
+    todo = {partition_id: pages_from for partition_id, pages_from in partitions.items()
+      if not self.checkpoint.partition(partition_id)['done']}
+    self.stats['partitions_done'] = len(partitions) - len(todo)
+
+    pages = queue.Queue(maxsize=QUEUE_PAGES)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+    for partition_id, pages_from in todo.items():
+      position = self.checkpoint.partition(partition_id)['position']
+      executor.submit(self._produce, pages, partition_id, (lambda pages_from=pages_from, position=position: pages_from(position)))
+
+    started_at = reported_at = self._clock()
+    remaining, errors = len(todo), 0
+    try:
+      while remaining and not self._stop.is_set():
+        kind, partition_id, records, position = pages.get()
+        partition = self.checkpoint.partition(partition_id)
+        if kind == 'page':
+          held_back = []
+          if self.max_records is not None:
+            n_records = max(0, self.max_records - self.stats['listed'])
+            records, held_back = records[:n_records], records[n_records:]
+          self.stats['listed'] += len(records)
+          written_before = self.writer.written
+          state['unwritten'].extend(self._put(records))
+          state['written'] += self.writer.written - written_before
+          # the position is past the whole page, so the next run sends the rest of it first
+          state['unwritten'].extend(held_back)
+          partition['position'] = position
+          if self.max_records is not None and self.stats['listed'] >= self.max_records:
+            print('[INFO] stopping after --max-records {}, {} records of the page are left for the next run'.format(
+              self.max_records, len(held_back)), file=sys.stderr)
+            break
+        else:
+          remaining -= 1
+          if kind == 'done':
+            partition['done'] = True
+            self.stats['partitions_done'] += 1
+          else:
+            errors += 1
+            print('[ERROR] partition {} failed, it is resumed by the next run: {!r}'.format(partition_id, records), file=sys.stderr)
+
+        now = self._clock()
+        if now - reported_at >= self.progress_seconds:
+          self.checkpoint.save()
+          print('[INFO] progress', json.dumps(self.progress(now - started_at)), file=sys.stderr)
+          reported_at = now
+    finally:
+      self._stop.set()
+      executor.shutdown(wait=True)
+      self.checkpoint.save()
+
+    summary = self.progress(self._clock() - started_at)
+    summary.update({'partitions': len(partitions), 'partition_errors': errors,
+      'total_written': state['written'], 'pending_unwritten': len(state['unwritten'])})
+    return summary
+
+  def progress(self, elapsed):
+    return dict(self.stats, written=self.writer.written, unwritten=self.writer.unwritten,
+      elapsed_seconds=round(elapsed, 1),
+      records_per_sec=round(self.writer.written / elapsed, 1) if elapsed else 0.0)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--bucket', help='bucket to list, unless --inventory-manifest is given')
+  parser.add_argument('--inventory-manifest', metavar='S3_URL', help='s3://.../manifest.json of a CSV S3 Inventory report')
+  parser.add_argument('--prefix', default=DEFAULT_PREFIX)
+  parser.add_argument('--suffixes', default=DEFAULT_SUFFIXES, help='comma separated key suffixes')
+  parser.add_argument('--split-chars', default=DEFAULT_SPLIT_CHARS, help='the key ranges are split at --prefix + these characters')
+  parser.add_argument('--split-depth', type=int, default=1, help='number of characters after --prefix to split at')
+  parser.add_argument('--stream-name', default=trigger_image_auto_tagger.KINESIS_STREAM_NAME)
+  parser.add_argument('--region', default=trigger_image_auto_tagger.AWS_REGION)
+  parser.add_argument('--rate', type=float, default=100.0, help='records/s written into the stream, 0 for no limit')
+  parser.add_argument('--batch-size', type=int, default=trigger_image_auto_tagger.MAX_PUT_RECORDS_COUNT)
+  parser.add_argument('--workers', type=int, default=8, help='key ranges (inventory files) read in parallel')
+  parser.add_argument('--checkpoint', default='backfill-checkpoint.json', help='progress file, resumed when it exists')
+  parser.add_argument('--max-records', type=int, help='stop after this many records, e.g. for a canary run')
+  parser.add_argument('--progress-seconds', type=float, default=10.0)
+  parser.add_argument('--dry-run', action='store_true', help='only log the records, the same as DRY_RUN=true')
+  options = parser.parse_args()
+
+  if bool(options.bucket) == bool(options.inventory_manifest):
+    parser.error('give one of --bucket or --inventory-manifest')
+  if options.dry_run:
+    trigger_image_auto_tagger.DRY_RUN = True
+  dry_run = trigger_image_auto_tagger.DRY_RUN
+
+  suffixes = tuple(suffix.strip() for suffix in options.suffixes.split(',') if suffix.strip())
+  s3_client = boto3.client('s3', region_name=options.region,
+    config=Config(max_pool_connections=max(10, options.workers)))
+  kinesis_client = boto3.client('kinesis', region_name=options.region)
+
+  if options.inventory_manifest:
+    report_bucket, manifest = read_inventory_manifest(s3_client, options.inventory_manifest)
+    source = {'inventory_manifest': options.inventory_manifest, 'prefix': options.prefix, 'suffixes': list(suffixes)}
+    partitions = {f['key']: (lambda position, key=f['key']: read_inventory_file(s3_client, report_bucket, key,
+        manifest['fileSchema'], options.prefix, suffixes, skip_rows=position or 0))
+      for f in manifest['files']}
+  else:
+    bounds = key_range_bounds(options.prefix, options.split_chars, options.split_depth)
+    source = {'bucket': options.bucket, 'prefix': options.prefix, 'suffixes': list(suffixes), 'bounds': bounds}
+    partitions = {}
+    for start_after, end in key_ranges(bounds):
+      partitions[start_after or ''] = (lambda position, start_after=start_after, end=end: list_key_range(s3_client,
+        options.bucket, options.prefix, suffixes, position or start_after, end))
+
+  # a dry run reads the checkpoint, but leaves it as it is
+  checkpoint = Checkpoint(options.checkpoint, source, enabled=not dry_run)
+  writer = RecordWriter(kinesis_client, options.stream_name, options.rate, batch_size=options.batch_size)
+  backfill = Backfill(writer, checkpoint, workers=options.workers, progress_seconds=options.progress_seconds,
+    max_records=options.max_records)
+  try:
+    summary = backfill.run(partitions)
+  except KeyboardInterrupt:
+    print('[WARN] interrupted, run the same command again to resume from {}'.format(options.checkpoint), file=sys.stderr)
+    sys.exit(130)
+  print(json.dumps(dict(summary, dry_run=dry_run)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Put the records of the dead-letter spool back into the Kinesis stream.
+
+  $ python src/main/python/Backfill/replay.py --stream-name image-auto-tagger-img --rate 500 \\
+      --spool https://sqs.us-east-1.amazonaws.com/123456789012/image-insights-dead-letters
+  $ python src/main/python/Backfill/replay.py --spool s3://bucket/dead-letters/ --stage bulk_index \\
+      --since 2020-11-18T09:00:00Z --dry-run
+
+The spool (see CommonLib dead_letter.py) is drained in batches of --batch-size entries.
+An image is put back once per batch however many of its failures were spooled, at most
+--rate records/s, and its entries are acked (deleted) once it is in the stream.
+The entries of stage `event_source`, the batches the event source mapping of the image
+tagger gave up on, are read back from the shard they came from, as long as the stream
+still keeps them (24 hours by default); an entry is acked once all its images are in
+the stream.
+
+Entries without a payload to replay, or left out by --source/--stage/--since, stay in
+the spool; an SQS spool hides them until its visibility timeout ends. With --dry-run
+(or DRY_RUN=true) nothing is written nor acked.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+# also puts CommonLib and the trigger on sys.path
+import backfill
+
+import boto3
+from botocore.exceptions import ClientError
+
+import dead_letter
+from kpl_aggregation import deaggregate
+import trigger_image_auto_tagger
+
+# GetRecords allows 5 calls/s per shard
+GET_RECORDS_INTERVAL_SECONDS = 0.2
+
+
+def _selected(entry, options):
+  return ((not options.source or entry.get('source') in options.source)
+    and (not options.stage or entry.get('stage') in options.stage)
+    and (not options.since or entry.get('failed_at', '') >= options.since))
+
+
+def read_kinesis_batch(kinesis_client, batch_info, sleep=time.sleep):
+  """Return the messages of the records of a `KinesisBatchInfo`, read back from its shard."""
+  end = int(batch_info['endSequenceNumber'])
+  iterator = kinesis_client.get_shard_iterator(StreamName=batch_info['streamArn'].split('/', 1)[1],
+    ShardId=batch_info['shardId'], ShardIteratorType='AT_SEQUENCE_NUMBER',
+    StartingSequenceNumber=batch_info['startSequenceNumber'])['ShardIterator']
+  messages = []
+  while iterator:
+    response = kinesis_client.get_records(ShardIterator=iterator, Limit=1000)
+    for record in response['Records']:
+      if int(record['SequenceNumber']) > end:
+        return messages
+      messages.extend(data for _, data in deaggregate(record['Data']))
+    if not response['Records'] and not response.get('MillisBehindLatest'):
+      return messages
+    iterator = response.get('NextShardIterator')
+    sleep(GET_RECORDS_INTERVAL_SECONDS)
+  return messages
+
+
+def _payloads(entry, kinesis_client):
+  if 'kinesis_batch' not in entry:
+    return [entry.get('payload') or {}]
+  payloads = []
+  for message in read_kinesis_batch(kinesis_client, entry['kinesis_batch']):
+    try:
+      payloads.append(json.loads(message))
+    except ValueError:
+      pass
+  return payloads
+
+
+def replay_batch(batch, writer, options, kinesis_client=None):
+  """Replay the entries of a drained batch, and return (handles to ack, counts)."""
+  counts = {'entries': len(batch), 'filtered': 0, 'not_replayable': 0, 'duplicates': 0}
+  records, handle_keys = {}, {}
+  for handle, entry in batch:
+    if not _selected(entry, options):
+      counts['filtered'] += 1
+      continue
+    try:
+      payloads = _payloads(entry, kinesis_client or writer.kinesis_client)
+    except ClientError as ex:
+      print('[WARN] failed to read back the batch of', json.dumps(entry['kinesis_batch']), repr(ex), file=sys.stderr)
+      payloads = []
+    # without the ETag, which is stale if the object was uploaded again since
+    keys = {(payload['s3_bucket'], payload['s3_key']) for payload in payloads
+      if isinstance(payload, dict) and payload.get('s3_bucket') and payload.get('s3_key')}
+    if not keys:
+      counts['not_replayable'] += 1
+      continue
+    for key in keys:
+      if key in records:
+        counts['duplicates'] += 1
+      records[key] = True
+    handle_keys[handle] = keys
+
+  unwritten = writer.put([{'s3_bucket': bucket, 's3_key': key} for bucket, key in records])
+  unwritten_keys = {(record['s3_bucket'], record['s3_key']) for record in unwritten}
+  return ([handle for handle, keys in handle_keys.items() if not keys & unwritten_keys], counts)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--spool', required=True, help='SQS queue URL, s3://bucket/prefix/ or local directory')
+  parser.add_argument('--stream-name', default=trigger_image_auto_tagger.KINESIS_STREAM_NAME)
+  parser.add_argument('--region', default=trigger_image_auto_tagger.AWS_REGION)
+  parser.add_argument('--rate', type=float, default=200.0, help='records/s written into the stream, 0 for no limit')
+  parser.add_argument('--batch-size', type=int, default=1000, help='entries drained at a time')
+  parser.add_argument('--max-entries', type=int, help='stop after draining this many entries')
+  parser.add_argument('--source', action='append', help='only the entries of this handler, e.g. ImageAutoTagger')
+  parser.add_argument('--stage', action='append', help='only the entries that failed at this stage, e.g. tag_image or event_source')
+  parser.add_argument('--since', help='only the entries that failed at or after this time, e.g. 2020-11-18T09:00:00Z')
+  parser.add_argument('--dry-run', action='store_true', help='only count the entries, the same as DRY_RUN=true')
+  options = parser.parse_args()
+
+  if options.dry_run:
+    trigger_image_auto_tagger.DRY_RUN = True
+  dry_run = trigger_image_auto_tagger.DRY_RUN
+
+  session = boto3.Session(region_name=options.region)
+  spool = dead_letter.create_spool(options.spool, session)
+  writer = backfill.RecordWriter(session.client('kinesis'), options.stream_name, options.rate,
+    batch_size=trigger_image_auto_tagger.MAX_PUT_RECORDS_COUNT)
+
+  totals = {'entries': 0, 'filtered': 0, 'not_replayable': 0, 'duplicates': 0, 'acked': 0}
+  started_at = time.monotonic()
+  for batch in spool.drain(options.batch_size):
+    handles, counts = replay_batch(batch, writer, options)
+    if not dry_run:
+      spool.ack(handles)
+    for name, count in counts.items():
+      totals[name] += count
+    totals['acked'] += 0 if dry_run else len(handles)
+    print('[INFO] progress', json.dumps(dict(totals, written=writer.written)), file=sys.stderr)
+    if options.max_entries is not None and totals['entries'] >= options.max_entries:
+      break
+
+  elapsed = time.monotonic() - started_at
+  print(json.dumps(dict(totals, written=writer.written, unwritten=writer.unwritten, dry_run=dry_run,
+    elapsed_seconds=round(elapsed, 1), records_per_sec=round(writer.written / elapsed, 1) if elapsed else 0.0)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Dead-letter spool of the records the handlers failed or dropped.
+
+An entry keeps the record together with where and why it failed:
+
+  {"source": "ImageAutoTagger", "stage": "tag_image", "error_class": "ClientError",
+   "error": "...", "failed_at": "2020-11-18T09:13:59Z",
+   "payload": {"s3_bucket": "image-insights", "s3_key": "raw-image/img7.jpeg"}}
+
+`payload` is the message of the Kinesis stream, so that Backfill/replay.py can put
+it back into the stream; what could not be decoded is kept under `raw` instead
+(base64 encoded if binary). Only the messages a handler gives up on are spooled, not
+the ones it leaves for a retry.
+
+The SQS queue is also the on-failure destination of the Kinesis event source mapping,
+whose messages only locate the batch that failed every retry; they are drained as
+entries of stage `event_source` with the batch under `kinesis_batch`, for
+Backfill/replay.py to read its records back from the stream.
+
+The spool is given as a URL:
+
+  - https://sqs.us-east-1.amazonaws.com/123456789012/image-insights-dead-letters: one message per entry
+  - s3://bucket/prefix/: one JSON lines object per `put`
+  - file:///var/tmp/dead-letters (or a plain path): the same files in a local directory
+"""
+
+import base64
+import datetime
+import json
+import os
+import sys
+import urllib.parse
+import uuid
+
+MAX_ERROR_CHARS = 1000
+
+# limits of SendMessageBatch and ReceiveMessage
+SQS_MAX_BATCH_COUNT = 10
+
+
+def dead_letter_entry(source, stage, error, payload=None, raw=None, error_class=None):
+  """`error` is the exception, or a message along with `error_class`."""
+  if error_class is None:
+    error_class = type(error).__name__ if isinstance(error, BaseException) else 'Error'
+  entry = {
+    'source': source,
+    'stage': stage,
+    'error_class': error_class,
+    'error': str(error)[:MAX_ERROR_CHARS],
+    'failed_at': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+  }
+  if payload is not None:
+    entry['payload'] = payload
+  if raw is not None:
+    entry['raw'] = base64.b64encode(raw).decode('ascii') if isinstance(raw, bytes) else raw
+  return entry
+
+
+def event_source_failure_entry(message):
+  """Return the entry of an on-failure message of a Kinesis event source mapping."""
+  request_context = message.get('requestContext', {})
+  function_name = request_context.get('functionArn', '').split(':function:')[-1].split(':')[0]
+  return {
+    'source': function_name or 'unknown',
+    'stage': 'event_source',
+    'error_class': request_context.get('condition', 'unknown'),
+    'error': 'gave up after {} invocations'.format(request_context.get('approximateInvokeCount')),
+    # 2019-11-14T00:38:06.021Z
+    'failed_at': message.get('timestamp', '')[:19] + 'Z',
+    'kinesis_batch': message['KinesisBatchInfo']
+  }
+
+
+def _sqs_entry(body):
+  message = json.loads(body)
+  return event_source_failure_entry(message) if 'KinesisBatchInfo' in message else message
+
+
+class SQSSpool:
+
+  def __init__(self, queue_url, sqs_client=None, visibility_timeout=900):
+    if sqs_client is None:
+      import boto3
+      sqs_client = boto3.client('sqs')
+    self.queue_url = queue_url
+    self.sqs_client = sqs_client
+    self.visibility_timeout = visibility_timeout
+
+  def put(self, entries):
+    """Send the entries, and return the ones that could not be sent."""
+    unsent = []
+    for i in range(0, len(entries), SQS_MAX_BATCH_COUNT):
+      batch = entries[i:i + SQS_MAX_BATCH_COUNT]
+      response = self.sqs_client.send_message_batch(QueueUrl=self.queue_url,
+        Entries=[{'Id': str(j), 'MessageBody': json.dumps(entry, ensure_ascii=False)} for j, entry in enumerate(batch)])
+      unsent.extend(batch[int(failure['Id'])] for failure in response.get('Failed', []))
+    return unsent
+
+  def drain(self, batch_size):
+    """Yield lists of (handle, entry) until the queue looks empty.
+
+    Entries that are not acked become visible again after `visibility_timeout`,
+    so they are not received twice by one drain.
+    """
+
+    while True:
+      batch = []
+      while len(batch) < batch_size:
+        response = self.sqs_client.receive_message(QueueUrl=self.queue_url,
+          MaxNumberOfMessages=min(SQS_MAX_BATCH_COUNT, batch_size - len(batch)),
+          VisibilityTimeout=self.visibility_timeout, WaitTimeSeconds=1)
+        messages = response.get('Messages', [])
+        if not messages:
+          break
+        batch.extend((message['ReceiptHandle'], _sqs_entry(message['Body'])) for message in messages)
+      if not batch:
+        return
+      yield batch
+
+  def ack(self, handles):
+    """Delete the entries of the handles from the queue."""
+    for i in range(0, len(handles), SQS_MAX_BATCH_COUNT):
+      self.sqs_client.delete_message_batch(QueueUrl=self.queue_url,
+        Entries=[{'Id': str(j), 'ReceiptHandle': handle} for j, handle in enumerate(handles[i:i + SQS_MAX_BATCH_COUNT])])
+
+
+class _FileSpool:
+  """JSON lines files under a prefix, one per `put`; subclasses store them."""
+
+  def __init__(self, prefix=''):
+    self.prefix = prefix
+
+  def _new_key(self, entries):
+    now = datetime.datetime.utcnow()
+    return '{}{}/{}-{}.jsonl'.format(self.prefix, now.strftime('%Y/%m/%d/%H'),
+      entries[0].get('source', 'unknown'), uuid.uuid4().hex)
+
+  def put(self, entries):
+    if entries:
+      self._write(self._new_key(entries),
+        b''.join(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n' for entry in entries))
+    return []
+
+  def drain(self, batch_size):
+    """Yield lists of (handle, entry) of whole files, the files listed when the drain started.
+
+    `ack` is called once with the handles of a batch, so a file is either deleted or
+    rewritten with the entries that were not acked.
+    """
+    batch = []
+    self._pending = {}
+    for key in sorted(self._list()):
+      lines = [line for line in self._read(key).splitlines() if line.strip()]
+      self._pending[key] = lines
+      batch.extend(((key, i), json.loads(line)) for i, line in enumerate(lines))
+      if len(batch) >= batch_size:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+
+  def ack(self, handles):
+    acked = {}
+    for key, i in handles:
+      acked.setdefault(key, set()).add(i)
+    for key, lines in list(self._pending.items()):
+      if key not in acked:
+        continue
+      left = [line for i, line in enumerate(lines) if i not in acked[key]]
+      if left:
+        self._write(key, b''.join(line + b'\n' for line in left))
+      else:
+        self._delete(key)
+      del self._pending[key]
+
+
+class S3Spool(_FileSpool):
+
+  def __init__(self, bucket, prefix='', s3_client=None):
+    super().__init__(prefix)
+    if s3_client is None:
+      import boto3
+      s3_client = boto3.client('s3')
+    self.bucket = bucket
+    self.s3_client = s3_client
+
+  def _write(self, key, data):
+    self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType='application/x-ndjson')
+
+  def _list(self):
+    for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix):
+      for obj in page.get('Contents', []):
+        if obj['Key'].endswith('.jsonl'):
+          yield obj['Key']
+
+  def _read(self, key):
+    return self.s3_client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+  def _delete(self, key):
+    self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+
+
+class LocalSpool(_FileSpool):
+  """The S3 spool in a local directory."""
+
+  def __init__(self, path):
+    super().__init__()
+    self.path = path
+
+  def _write(self, key, data):
+    path = os.path.join(self.path, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(data)
+    os.replace(tmp_path, path)
+
+  def _list(self):
+    for root, _, files in os.walk(self.path):
+      for name in files:
+        if name.endswith('.jsonl'):
+          yield os.path.relpath(os.path.join(root, name), self.path)
+
+  def _read(self, key):
+    with open(os.path.join(self.path, key), 'rb') as f:
+      return f.read()
+
+  def _delete(self, key):
+    os.remove(os.path.join(self.path, key))
+
+
+def create_spool(url, session=None):
+  """Return the spool of the URL, or None if it is empty."""
+  if not url:
+    return None
+  client = (session.client if session is not None else None)
+  parsed = urllib.parse.urlsplit(url)
+  if parsed.scheme == 'https' and parsed.netloc.startswith('sqs.'):
+    return SQSSpool(url, sqs_client=client('sqs') if client else None)
+  if parsed.scheme == 's3':
+    prefix = parsed.path.lstrip('/')
+    if prefix and not prefix.endswith('/'):
+      prefix += '/'
+    return S3Spool(parsed.netloc, prefix, s3_client=client('s3') if client else None)
+  if parsed.scheme in ('', 'file'):
+    return LocalSpool(parsed.path)
+  raise ValueError('unsupported dead-letter spool: {}'.format(url))
+
+
+def write_dead_letters(spool, entries):
+  """Put the entries into the spool; the ones it does not take end up in the log."""
+  if not entries:
+    return
+  unsent = entries
+  if spool is not None:
+    try:
+      unsent = spool.put(entries)
+    except Exception as ex:
+      print('[ERROR] failed to write into the dead-letter spool: {!r}'.format(ex), file=sys.stderr)
+  for entry in unsent:
+    print('[ERROR] dead letter', json.dumps(entry, ensure_ascii=False), file=sys.stderr)
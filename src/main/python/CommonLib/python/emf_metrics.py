@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import contextlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+# CloudWatch accepts at most 100 values per metric in an EMF document
+MAX_VALUES_PER_METRIC = 100
+
+VERBOSE_LOG_SAMPLE_RATE = float(os.getenv('VERBOSE_LOG_SAMPLE_RATE', '0.01'))
+
+
+def should_log_verbose(rate=None):
+  """Return True for a `rate` fraction of the calls, to sample verbose logs."""
+  rate = VERBOSE_LOG_SAMPLE_RATE if rate is None else rate
+  return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+
+class StageMetrics:
+  """Collect per-stage latencies, counts and error classes and write them as
+  CloudWatch Embedded Metric Format (EMF) lines to stdout.
+
+  For every stage, `flush()` writes a `Latency` metric holding all the recorded
+  values (so CloudWatch keeps their distribution) and a `Count`, with the
+  dimensions `Service` and `Stage`. Errors go to an `Errors` metric with an
+  extra `ErrorClass` dimension; other values of the invocation can be added
+  with `put_metric()`.
+  """
+
+  def __init__(self, namespace, service, stream=None):
+    self.namespace = namespace
+    self.service = service
+    self.stream = stream
+    self._lock = threading.Lock()
+    self._reset()
+
+  def _reset(self):
+    self._latencies = {}
+    self._errors = {}
+    self._metrics = {}
+
+  def add_latency(self, stage, elapsed_ms):
+    with self._lock:
+      self._latencies.setdefault(stage, []).append(round(elapsed_ms, 3))
+
+  def add_error(self, stage, error):
+    error_class = error if isinstance(error, str) else type(error).__name__
+    with self._lock:
+      key = (stage, error_class)
+      self._errors[key] = self._errors.get(key, 0) + 1
+
+  def put_metric(self, name, value, unit='Count'):
+    with self._lock:
+      self._metrics[name] = (value, unit)
+
+  @contextlib.contextmanager
+  def timer(self, stage):
+    """Time the block as one call of `stage`, and count the class of the exception it raises."""
+    started_at = time.perf_counter()
+    try:
+      yield
+    except Exception as ex:
+      self.add_error(stage, ex)
+      raise
+    finally:
+      self.add_latency(stage, (time.perf_counter() - started_at) * 1000)
+
+  def _document(self, dimensions, metrics, values):
+    doc = {
+      '_aws': {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+          'Namespace': self.namespace,
+          'Dimensions': [list(dimensions.keys())],
+          'Metrics': [{'Name': name, 'Unit': unit} for name, unit in metrics]
+        }]
+      }
+    }
+    doc.update(dimensions)
+    doc.update(values)
+    return doc
+
+  def documents(self):
+    """Return the EMF documents of the collected values and reset them."""
+    with self._lock:
+      latencies, errors, metrics = self._latencies, self._errors, self._metrics
+      self._reset()
+
+    docs = []
+    for stage, values in sorted(latencies.items()):
+      for i in range(0, len(values), MAX_VALUES_PER_METRIC):
+        chunk = values[i:i + MAX_VALUES_PER_METRIC]
+        docs.append(self._document({'Service': self.service, 'Stage': stage},
+          [('Latency', 'Milliseconds'), ('Count', 'Count')],
+          {'Latency': chunk, 'Count': len(chunk)}))
+
+    for (stage, error_class), count in sorted(errors.items()):
+      docs.append(self._document({'Service': self.service, 'Stage': stage, 'ErrorClass': error_class},
+        [('Errors', 'Count')], {'Errors': count}))
+
+    if metrics:
+      docs.append(self._document({'Service': self.service},
+        [(name, unit) for name, (_, unit) in sorted(metrics.items())],
+        {name: value for name, (value, _) in metrics.items()}))
+    return docs
+
+  def flush(self):
+    stream = self.stream or sys.stdout
+    for doc in self.documents():
+      stream.write(json.dumps(doc, separators=(',', ':')) + '\n')
+    stream.flush()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import threading
+
+from elasticsearch import Elasticsearch
+from elasticsearch import RequestsHttpConnection
+from requests_aws4auth import AWS4Auth
+
+
+class RefreshableAWS4Auth:
+  """Sign requests with the current credentials of a botocore credentials object.
+
+  `AWS4Auth` keeps the keys it was built with, so a long-lived client ends up
+  signing with an expired session token. This asks the credentials object for
+  its frozen credentials on every request (botocore refreshes them shortly
+  before they expire) and rebuilds the signer only when they changed.
+  """
+
+  def __init__(self, credentials, region, service='es'):
+    self.credentials = credentials
+    self.region = region
+    self.service = service
+    self._lock = threading.Lock()
+    self._frozen = None
+    self._auth = None
+
+  def _current_auth(self):
+    frozen = self.credentials.get_frozen_credentials()
+    with self._lock:
+      if frozen != self._frozen:
+        self._auth = AWS4Auth(frozen.access_key, frozen.secret_key, self.region,
+          self.service, session_token=frozen.token)
+        self._frozen = frozen
+      return self._auth
+
+  def __call__(self, request):
+    return self._current_auth()(request)
+
+
+def create_es_client(host, session, region, **kwargs):
+  return Elasticsearch(
+    hosts = [{'host': host, 'port': 443}],
+    http_auth=RefreshableAWS4Auth(session.get_credentials(), region),
+    use_ssl=True,
+    verify_certs=True,
+    connection_class=RequestsHttpConnection,
+    **kwargs
+  )
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Index template, write alias and rollover of the image index.
+
+Documents are written through the alias `<name>`, which points at a series of
+time-stamped indices `<name>-YYYY.MM.DD-000001`, `<name>-YYYY.MM.DD-000002`, ...
+matched by the index template `<name>`. Searches through the alias cover them all.
+
+Try it against a local OpenSearch (no SigV4):
+
+  $ docker run -d -p 9200:9200 -e discovery.type=single-node -e DISABLE_SECURITY_PLUGIN=true \\
+      opensearchproject/opensearch:1.3.0
+  $ python index_bootstrap.py --host http://localhost:9200 --alias image_insights
+  $ python index_bootstrap.py --host http://localhost:9200 --alias image_insights --rollover --max-age 1s
+"""
+
+import sys
+
+MAPPINGS = {
+  'dynamic_templates': [
+    {'strings_as_keywords': {'match_mapping_type': 'string', 'mapping': {'type': 'keyword'}}}
+  ],
+  'properties': {
+    'doc_id': {'type': 'keyword'},
+    'image_id': {'type': 'keyword'},
+    'image_url': {'type': 'keyword', 'index': False},
+    'tags': {'type': 'keyword'},
+    'tag_id': {'type': 'keyword'},
+    'tag_confidence': {'type': 'keyword'},
+    'tag_instances': {'type': 'keyword'},
+    'instance_count': {'type': 'short'},
+    'boxes': {'type': 'keyword', 'index': False, 'doc_values': False},
+    'box_cells': {'type': 'keyword'},
+    'detected_text': {'type': 'text'},
+    'moderation_labels': {'type': 'keyword'},
+    'face_count': {'type': 'short'},
+    'failed_stages': {'type': 'keyword'},
+    'phash': {'type': 'keyword', 'index': False},
+    'near_dup_of': {'type': 'keyword'},
+    'content_id': {'type': 'keyword', 'index': False},
+    'created_at': {'type': 'date', 'format': 'strict_date_time_no_millis||strict_date_optional_time'}
+  }
+}
+
+
+def index_template(alias, number_of_shards=1, number_of_replicas=1, refresh_interval='30s'):
+  return {
+    'index_patterns': ['{}-*'.format(alias)],
+    'template': {
+      'settings': {
+        'index': {
+          'number_of_shards': number_of_shards,
+          'number_of_replicas': number_of_replicas,
+          # documents arrive in bulk from the tagger, nobody needs them searchable within 1s
+          'refresh_interval': refresh_interval,
+          # newest first is the common sort, and lets the search stop early
+          'sort.field': 'created_at',
+          'sort.order': 'desc'
+        }
+      },
+      'mappings': MAPPINGS
+    }
+  }
+
+
+ROLLUP_MAPPINGS = {
+  'dynamic': 'strict',
+  'properties': {
+    'granularity': {'type': 'keyword'},
+    'bucket_start': {'type': 'date', 'format': 'strict_date_time_no_millis'},
+    'tag': {'type': 'keyword'},
+    'count': {'type': 'long'}
+  }
+}
+
+
+def rollup_index_template(index, number_of_replicas=1):
+  return {
+    'index_patterns': [index],
+    'template': {
+      'settings': {
+        'index': {
+          # a few small documents, updated in place
+          'number_of_shards': 1,
+          'number_of_replicas': number_of_replicas,
+          'refresh_interval': '30s'
+        }
+      },
+      'mappings': ROLLUP_MAPPINGS
+    }
+  }
+
+
+def _index_body(alias, **settings):
+  """The settings and mappings of the index template, for the indices created by the tagger.
+
+  Given explicitly, so that those indices are right even if the template could not be put.
+  """
+  return dict(index_template(alias, **settings)['template'])
+
+
+def _already_exists(ex):
+  return getattr(ex, 'error', None) == 'resource_already_exists_exception'
+
+
+def put_index_template(es_client, alias, **settings):
+  #XXX: the composable template API (Elasticsearch 7.8+, OpenSearch) is not wrapped by every 7.x client
+  es_client.transport.perform_request('PUT', '/_index_template/{}'.format(alias),
+    body=index_template(alias, **settings))
+
+
+def get_index_template_settings(es_client, alias):
+  """Return the index settings of the template `alias`, or None if there is no such template."""
+  try:
+    response = es_client.transport.perform_request('GET', '/_index_template/{}'.format(alias))
+  except Exception as ex:
+    if getattr(ex, 'status_code', None) == 404:
+      return None
+    raise
+  for template in response.get('index_templates', []):
+    if template['name'] == alias:
+      return template['index_template'].get('template', {}).get('settings', {}).get('index', {})
+  return None
+
+
+def put_rollup_index_template(es_client, index, **settings):
+  """The rollup index itself is created by the first upsert."""
+  es_client.transport.perform_request('PUT', '/_index_template/{}'.format(index),
+    body=rollup_index_template(index, **settings))
+
+
+def ensure_write_alias(es_client, alias, **settings):
+  """Create the first index behind the write alias unless the alias exists.
+
+  Returns False when `alias` is the name of a concrete index created before the
+  template, which is then written to as it is.
+  """
+  if es_client.indices.exists_alias(name=alias):
+    return True
+  if es_client.indices.exists(index=alias):
+    print('[WARN] {} is an index, not an alias; rebuild it with Reindex/reindex.py --swap --replace-index to use rollover'.format(alias), file=sys.stderr)
+    return False
+  try:
+    # date math, resolved by the cluster: <image_insights-{now/d}-000001>
+    es_client.indices.create(index='<{}-{{now/d}}-000001>'.format(alias),
+      body=dict(_index_body(alias, **settings), aliases={alias: {'is_write_index': True}}))
+  except Exception as ex:
+    # another function created it at the same time
+    if not _already_exists(ex):
+      raise
+  return True
+
+
+def bootstrap(es_client, alias, **settings):
+  """Put the index template and create the write alias; returns what `ensure_write_alias` does.
+
+  Putting the template needs the `cluster_manage_index_templates` permission; without
+  it the alias is still created, since the tagger must not write to `alias` before it is.
+  """
+  try:
+    put_index_template(es_client, alias, **settings)
+  except Exception as ex:
+    print('[WARN] failed to put the index template {}: {}'.format(alias, ex), file=sys.stderr)
+  return ensure_write_alias(es_client, alias, **settings)
+
+
+def rollover(es_client, alias, max_age='30d', max_docs=None, max_size=None, **settings):
+  """Roll the write alias over to a new index if the current one meets any of the conditions."""
+  conditions = {'max_age': max_age}
+  if max_docs:
+    conditions['max_docs'] = max_docs
+  if max_size:
+    conditions['max_size'] = max_size
+  body = dict(_index_body(alias, **settings), conditions=conditions)
+  response = es_client.indices.rollover(alias=alias, body=body)
+  if response.get('rolled_over'):
+    print('[INFO] rolled {} over from {} to {}'.format(alias, response['old_index'], response['new_index']), file=sys.stderr)
+  return response
+
+
+def next_index_name(es_client, alias, date_stamp):
+  """Return `<alias>-<date_stamp>-<generation>` after the highest generation of the indices of the alias.
+
+  The new index matches the index template, and rollover goes on counting from it.
+  """
+  generations = [0]
+  for index in es_client.indices.get(index='{}-*'.format(alias)):
+    suffix = index.rsplit('-', 1)[-1]
+    if suffix.isdigit():
+      generations.append(int(suffix))
+  return '{}-{}-{:06d}'.format(alias, date_stamp, max(generations) + 1)
+
+
+def swap_alias(es_client, alias, index, replace_index=False):
+  """Point the alias at `index` only, as its write index, in one atomic request.
+
+  If `alias` is a concrete index (see `ensure_write_alias`), it is deleted by the
+  same request when `replace_index` is set. Returns the indices the alias left, to be
+  deleted once the new index is verified.
+  """
+  if es_client.indices.exists_alias(name=alias):
+    old_indices = sorted(es_client.indices.get_alias(name=alias))
+    actions = [{'remove': {'index': old_index, 'alias': alias}} for old_index in old_indices if old_index != index]
+  elif es_client.indices.exists(index=alias):
+    if not replace_index:
+      raise ValueError('{} is an index, not an alias; it has to be replaced by the alias'.format(alias))
+    old_indices = []
+    actions = [{'remove_index': {'index': alias}}]
+  else:
+    old_indices, actions = [], []
+  actions.append({'add': {'index': index, 'alias': alias, 'is_write_index': True}})
+  es_client.indices.update_aliases(body={'actions': actions})
+  return [old_index for old_index in old_indices if old_index != index]
+
+
+def main():
+  import argparse
+
+  from elasticsearch import Elasticsearch
+
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--host', default='http://localhost:9200', help='URL of an OpenSearch without authentication')
+  parser.add_argument('--alias', default='image_insights')
+  parser.add_argument('--shards', type=int, default=1)
+  parser.add_argument('--replicas', type=int, default=0)
+  parser.add_argument('--refresh-interval', default='30s')
+  parser.add_argument('--rollover', action='store_true')
+  parser.add_argument('--max-age', default='30d')
+  parser.add_argument('--max-docs', type=int)
+  parser.add_argument('--max-size')
+  options = parser.parse_args()
+
+  es_client = Elasticsearch([options.host])
+  bootstrap(es_client, options.alias, number_of_shards=options.shards,
+    number_of_replicas=options.replicas, refresh_interval=options.refresh_interval)
+  if options.rollover:
+    rollover(es_client, options.alias, max_age=options.max_age, max_docs=options.max_docs, max_size=options.max_size,
+      number_of_shards=options.shards, number_of_replicas=options.replicas, refresh_interval=options.refresh_interval)
+  print(es_client.indices.get_alias(name=options.alias))
+
+
+if __name__ == '__main__':
+  main()
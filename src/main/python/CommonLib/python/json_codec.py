@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""JSON encoding to UTF-8 bytes, with orjson when it is installed.
+
+Both backends produce compact JSON with non-ASCII characters kept as UTF-8,
+so the output can go straight into a bulk request body or a Kinesis record.
+"""
+
+import json
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def _stdlib_dumps(obj):
+  return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _stdlib_loads(data):
+  return json.loads(data)
+
+
+if orjson is not None:
+  dumps, loads = orjson.dumps, orjson.loads
+else:
+  dumps, loads = _stdlib_dumps, _stdlib_loads
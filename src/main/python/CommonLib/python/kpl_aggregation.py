@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Kinesis Producer Library (KPL) record aggregation.
+
+An aggregated record is the KPL magic number, a protobuf `AggregatedRecord`
+message and the MD5 digest of that message:
+
+  message AggregatedRecord {
+    repeated string partition_key_table = 1;
+    repeated string explicit_hash_key_table = 2;
+    repeated Record records = 3;
+  }
+  message Record {
+    required uint64 partition_key_index = 1;
+    optional uint64 explicit_hash_key_index = 2;
+    required bytes data = 3;
+    repeated Tag tags = 4;
+  }
+
+See https://github.com/awslabs/amazon-kinesis-producer/blob/master/aggregation-format.md
+"""
+
+import hashlib
+
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+DIGEST_SIZE = 16
+
+# the KPL default of AggregationMaxSize
+DEFAULT_MAX_AGGREGATED_SIZE = 51200
+
+_WIRE_VARINT, _WIRE_LENGTH_DELIMITED = 0, 2
+
+
+def _encode_varint(value):
+  out = bytearray()
+  while True:
+    bits = value & 0x7f
+    value >>= 7
+    if value:
+      out.append(bits | 0x80)
+    else:
+      out.append(bits)
+      return bytes(out)
+
+
+def _decode_varint(buf, pos):
+  result, shift = 0, 0
+  while True:
+    if pos >= len(buf):
+      raise ValueError('truncated varint')
+    b = buf[pos]
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if not b & 0x80:
+      return result, pos
+    shift += 7
+
+
+def _key(field_number, wire_type):
+  return _encode_varint((field_number << 3) | wire_type)
+
+
+def _length_delimited(field_number, payload):
+  return _key(field_number, _WIRE_LENGTH_DELIMITED) + _encode_varint(len(payload)) + payload
+
+
+def _encode_record(partition_key_index, data):
+  message = _key(1, _WIRE_VARINT) + _encode_varint(partition_key_index) + _length_delimited(3, data)
+  return _length_delimited(3, message)
+
+
+def _iter_fields(buf):
+  pos = 0
+  while pos < len(buf):
+    key, pos = _decode_varint(buf, pos)
+    field_number, wire_type = key >> 3, key & 0x07
+    if wire_type == _WIRE_VARINT:
+      value, pos = _decode_varint(buf, pos)
+    elif wire_type == _WIRE_LENGTH_DELIMITED:
+      length, pos = _decode_varint(buf, pos)
+      if pos + length > len(buf):
+        raise ValueError('truncated field')
+      value, pos = buf[pos:pos + length], pos + length
+    else:
+      raise ValueError('unsupported wire type: {}'.format(wire_type))
+    yield field_number, value
+
+
+class RecordAggregator:
+  """Pack user records into KPL aggregated records of at most `max_size` bytes.
+
+  `add()` returns a finished `(partition_key, data)` record whenever the new user
+  record does not fit into the current one; call `flush()` for the last one.
+  The aggregated record takes the partition key of its first user record.
+  A single user record is returned as is, since it gains nothing from aggregation.
+  """
+
+  def __init__(self, max_size=DEFAULT_MAX_AGGREGATED_SIZE):
+    self.max_size = max_size
+    self._reset()
+
+  def _reset(self):
+    self._partition_keys = {}
+    self._user_records = []
+    self._body = bytearray()
+
+  def _size_with(self, encoded_key, encoded_record):
+    return len(KPL_MAGIC) + len(self._body) + len(encoded_key) + len(encoded_record) + DIGEST_SIZE
+
+  def add(self, partition_key, data):
+    finished = None
+    if self._user_records:
+      index = self._partition_keys.get(partition_key, len(self._partition_keys))
+      new_key = b'' if partition_key in self._partition_keys else _length_delimited(1, partition_key.encode('utf-8'))
+      if self._size_with(new_key, _encode_record(index, data)) > self.max_size:
+        finished = self.flush()
+
+    index = self._partition_keys.get(partition_key)
+    if index is None:
+      index = self._partition_keys[partition_key] = len(self._partition_keys)
+      self._body += _length_delimited(1, partition_key.encode('utf-8'))
+    self._body += _encode_record(index, data)
+    self._user_records.append((partition_key, data))
+    return finished
+
+  def flush(self):
+    if not self._user_records:
+      return None
+    if len(self._user_records) == 1:
+      record = self._user_records[0]
+    else:
+      body = bytes(self._body)
+      record = (self._user_records[0][0], KPL_MAGIC + body + hashlib.md5(body).digest())
+    self._reset()
+    return record
+
+
+def aggregate(user_records, max_size=DEFAULT_MAX_AGGREGATED_SIZE):
+  """Return the `(partition_key, data)` records packing the given `(partition_key, data)` user records."""
+  aggregator = RecordAggregator(max_size)
+  records = []
+  for partition_key, data in user_records:
+    finished = aggregator.add(partition_key, data)
+    if finished is not None:
+      records.append(finished)
+  last = aggregator.flush()
+  if last is not None:
+    records.append(last)
+  return records
+
+
+def is_aggregated(data):
+  return (len(data) > len(KPL_MAGIC) + DIGEST_SIZE
+    and data[:len(KPL_MAGIC)] == KPL_MAGIC
+    and hashlib.md5(data[len(KPL_MAGIC):-DIGEST_SIZE]).digest() == data[-DIGEST_SIZE:])
+
+
+def deaggregate(data, partition_key=None):
+  """Return the `(partition_key, data)` user records of a Kinesis record.
+
+  A record that is not KPL aggregated (or whose digest does not match) is
+  returned as the only user record, with the given `partition_key`.
+  Raises ValueError if an aggregated record can not be decoded.
+  """
+  if not is_aggregated(data):
+    return [(partition_key, data)]
+
+  partition_keys, user_records = [], []
+  for field_number, value in _iter_fields(data[len(KPL_MAGIC):-DIGEST_SIZE]):
+    if field_number in (1, 3) and not isinstance(value, bytes):
+      raise ValueError('field {} of AggregatedRecord is not length-delimited'.format(field_number))
+    if field_number == 1:
+      partition_keys.append(value.decode('utf-8'))
+    elif field_number == 3:
+      key_index, user_data = 0, b''
+      for record_field, record_value in _iter_fields(value):
+        if record_field == 1:
+          key_index = record_value
+        elif record_field == 3:
+          user_data = record_value
+      if not isinstance(key_index, int):
+        raise ValueError('partition_key_index is not a varint')
+      if not isinstance(user_data, bytes):
+        raise ValueError('data of Record is not length-delimited')
+      user_records.append((key_index, user_data))
+  for key_index, _ in user_records:
+    if key_index >= len(partition_keys):
+      raise ValueError('partition_key_index out of range: {}'.format(key_index))
+  return [(partition_keys[key_index], user_data) for key_index, user_data in user_records]
+
+
+if __name__ == '__main__':
+  import json
+
+  user_records = [('part-{:05}'.format(i % 3), json.dumps({'s3_bucket': 'november-photo',
+    's3_key': 'raw-image/img-{:04}.jpg'.format(i)}).encode('utf-8')) for i in range(500)]
+  records = aggregate(user_records, max_size=4096)
+  print('user records: {}, aggregated records: {}'.format(len(user_records), len(records)))
+
+  roundtrip = [user_record for partition_key, data in records for user_record in deaggregate(data, partition_key)]
+  assert roundtrip == user_records
+  assert deaggregate(b'{"plain": true}', 'pk') == [('pk', b'{"plain": true}')]
+
+  body = _length_delimited(1, b'pk') + _encode_record(1, b'{}')
+  varint_key = _key(1, _WIRE_VARINT) + _encode_varint(7) + _encode_record(0, b'{}')
+  varint_record = _length_delimited(1, b'pk') + _key(3, _WIRE_VARINT) + _encode_varint(7)
+  varint_data = _length_delimited(1, b'pk') + _length_delimited(3, _key(1, _WIRE_VARINT) + _encode_varint(0)
+    + _key(3, _WIRE_VARINT) + _encode_varint(7))
+  for corrupt in (body, body[:-1], _length_delimited(1, b'\xff') + _encode_record(0, b'{}'),
+      varint_key, varint_record, varint_data):
+    try:
+      deaggregate(KPL_MAGIC + corrupt + hashlib.md5(corrupt).digest())
+      assert False, corrupt
+    except ValueError:
+      pass
+  print('round trip: OK')
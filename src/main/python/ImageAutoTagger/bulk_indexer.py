@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import random
+import time
+
+import json_codec
+
+
+def _is_retryable_status(status):
+  return status == 429 or status >= 500
+
+
+def _is_retryable_error(ex):
+  status = getattr(ex, 'status_code', None)
+  if isinstance(status, int):
+    return _is_retryable_status(status)
+  #XXX: elasticsearch-py raises ConnectionError/ConnectionTimeout with status_code 'N/A'
+  return status is not None
+
+
+class BulkResult:
+
+  def __init__(self):
+    self.items = []
+    self.failed = []
+    self.chunks = []
+
+  @property
+  def succeeded(self):
+    return len(self.items) - len(self.failed)
+
+  def summary(self):
+    return {
+      'items': len(self.items),
+      'failed': len(self.failed),
+      'chunks': len(self.chunks),
+      'retried': sum(chunk['retried'] for chunk in self.chunks),
+      'elapsed_ms': round(sum(chunk['elapsed_ms'] for chunk in self.chunks), 3)
+    }
+
+
+class BulkIndexer:
+  """Send bulk actions to Elasticsearch/OpenSearch in size-bounded chunks.
+
+  Actions are `(action_meta, source)` pairs, e.g.
+  `({'index': {'_index': 'photos', '_id': '1'}}, {'tags': ['Car']})`;
+  `source` is None for actions without a body such as `delete`.
+
+  Each chunk is limited to `max_chunk_docs` actions and `max_chunk_bytes` bytes
+  and is serialized as the actions are consumed. Items rejected with 429 or 5xx
+  are resent with full-jitter exponential backoff; other item errors are final.
+  No refresh is requested, so new documents become visible on the index's own
+  refresh interval.
+  """
+
+  def __init__(self, es_client, max_chunk_docs=500, max_chunk_bytes=5 * 1024 * 1024,
+      max_retries=3, initial_backoff=0.2, max_backoff=5.0, sleep=time.sleep):
+    self.es_client = es_client
+    self.max_chunk_docs = max_chunk_docs
+    self.max_chunk_bytes = max_chunk_bytes
+    self.max_retries = max_retries
+    self.initial_backoff = initial_backoff
+    self.max_backoff = max_backoff
+    self._sleep = sleep
+
+  def _serialize(self, action_meta, source):
+    line = json_codec.dumps(action_meta) + b'\n'
+    if source is not None:
+      line += json_codec.dumps(source) + b'\n'
+    return line
+
+  def _iter_chunks(self, actions):
+    """Yield lists of (position, serialized lines) that fit in one bulk request."""
+    chunk, chunk_bytes = [], 0
+    for position, (action_meta, source) in enumerate(actions):
+      lines = self._serialize(action_meta, source)
+      if chunk and (len(chunk) >= self.max_chunk_docs or chunk_bytes + len(lines) > self.max_chunk_bytes):
+        yield chunk
+        chunk, chunk_bytes = [], 0
+      chunk.append((position, lines))
+      chunk_bytes += len(lines)
+    if chunk:
+      yield chunk
+
+  def _backoff(self, attempt):
+    self._sleep(random.uniform(0, min(self.max_backoff, self.initial_backoff * (2 ** attempt))))
+
+  def _send_chunk(self, chunk, result):
+    started_at = time.perf_counter()
+    stats = {'chunk': len(result.chunks), 'docs': len(chunk),
+      'bytes': sum(len(lines) for _, lines in chunk), 'attempts': 0, 'retried': 0, 'failed': 0}
+
+    final = {}
+    pending = chunk
+    for attempt in range(self.max_retries + 1):
+      if attempt > 0:
+        stats['retried'] += len(pending)
+        self._backoff(attempt - 1)
+      stats['attempts'] += 1
+
+      body = b''.join(lines for _, lines in pending)
+      retry = []
+      try:
+        response = self.es_client.bulk(body=body)
+      except Exception as ex:
+        status = getattr(ex, 'status_code', None)
+        error = {'type': type(ex).__name__, 'reason': str(ex)}
+        for position, lines in pending:
+          final[position] = {'status': status if isinstance(status, int) else None, 'error': error}
+        if _is_retryable_error(ex):
+          retry = pending
+      else:
+        for (position, lines), item in zip(pending, response['items']):
+          op_result = next(iter(item.values()))
+          final[position] = op_result
+          if 'error' in op_result and _is_retryable_status(op_result.get('status', 0)):
+            retry.append((position, lines))
+
+      pending = retry
+      if not pending:
+        break
+
+    for position, _ in chunk:
+      op_result = final[position]
+      result.items.append(op_result)
+      if 'error' in op_result:
+        stats['failed'] += 1
+        result.failed.append({'index': position, 'status': op_result.get('status'), 'error': op_result['error']})
+
+    stats['elapsed_ms'] = round((time.perf_counter() - started_at) * 1000, 3)
+    result.chunks.append(stats)
+
+  def index(self, actions):
+    """Send all the actions and return a `BulkResult`.
+
+    `BulkResult.items` holds the final per-item response in the order of `actions`,
+    `BulkResult.failed` the items that never succeeded and `BulkResult.chunks`
+    the timing and failure counts per chunk.
+    """
+    result = BulkResult()
+    for chunk in self._iter_chunks(actions):
+      self._send_chunk(chunk, result)
+    return result
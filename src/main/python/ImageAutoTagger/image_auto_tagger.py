@@ -9,42 +9,327 @@ import os
 import traceback
 import hashlib
 import datetime
+import threading
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
-from elasticsearch import Elasticsearch
-from elasticsearch import RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
+from botocore.config import Config
+
+from bulk_indexer import BulkIndexer
+from dead_letter import (
+  create_spool,
+  dead_letter_entry,
+  write_dead_letters
+)
+from emf_metrics import (
+  StageMetrics,
+  should_log_verbose
+)
+from es_client import create_es_client
+import image_preprocessor
+import index_bootstrap
+import json_codec
+from kpl_aggregation import deaggregate
+from label_fields import (
+  label_fields,
+  select_labels
+)
+from label_cache import (
+  LRUCache,
+  LabelCache,
+  SQLiteLabelStore,
+  DynamoDBLabelStore
+)
+from near_duplicate import (
+  NearDuplicateIndex,
+  dhash,
+  fetch_labels,
+  format_hash
+)
+from rollups import (
+  BUCKET_FORMATS,
+  rollup_actions,
+  rollup_counts
+)
+from rate_limiter import (
+  AdaptiveRateLimiter,
+  DeadlineExceededError,
+  is_throttling_error,
+  is_transient_error
+)
 
 S3_URL_FMT = 'https://{bucket_name}.s3.amazonaws.com/{object_key}'
 
 AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 
-ES_INDEX, ES_TYPE = (os.getenv('ES_INDEX', 'november_photo'), os.getenv('ES_TYPE', 'photo'))
+#XXX: the write alias of the index; the indices behind it are rolled over by the tagger
+ES_INDEX = os.getenv('ES_INDEX', 'november_photo')
 ES_HOST = os.getenv('ES_HOST')
 
+#XXX: installs the index template and creates the write alias on the first invocation
+INDEX_BOOTSTRAP = (os.getenv('INDEX_BOOTSTRAP', 'true') == 'true')
+INDEX_SHARDS = int(os.getenv('INDEX_SHARDS', '1'))
+INDEX_REPLICAS = int(os.getenv('INDEX_REPLICAS', '1'))
+INDEX_REFRESH_INTERVAL = os.getenv('INDEX_REFRESH_INTERVAL', '30s')
+#XXX: every function instance asks for a rollover at most once per INDEX_ROLLOVER_CHECK_SECONDS;
+# the cluster only rolls over when the write index meets one of the conditions
+INDEX_ROLLOVER_CHECK_SECONDS = int(os.getenv('INDEX_ROLLOVER_CHECK_SECONDS', '3600'))
+INDEX_ROLLOVER_MAX_AGE = os.getenv('INDEX_ROLLOVER_MAX_AGE', '30d')
+INDEX_ROLLOVER_MAX_DOCS = int(os.getenv('INDEX_ROLLOVER_MAX_DOCS', '0'))
+INDEX_ROLLOVER_MAX_SIZE = os.getenv('INDEX_ROLLOVER_MAX_SIZE')
+
+#XXX: content_id of the documents indexed by this function instance, to skip re-indexing unchanged ones
+INDEXED_CONTENT_ID_CACHE_SIZE = int(os.getenv('INDEXED_CONTENT_ID_CACHE_SIZE', '100000'))
+
+#XXX: tag counts per time bucket for the dashboards; set ROLLUP_GRANULARITIES empty to disable them
+ROLLUP_INDEX = os.getenv('ROLLUP_INDEX', '{}_rollups'.format(ES_INDEX))
+ROLLUP_GRANULARITIES = [name.strip() for name in os.getenv('ROLLUP_GRANULARITIES', 'minute,hour,day').split(',')
+  if name.strip()]
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'ImageInsights')
+
+#XXX: SQS queue URL, s3://bucket/prefix/ or local directory of the messages that failed
+DEAD_LETTER_SPOOL = os.getenv('DEAD_LETTER_SPOOL')
+
+#XXX: 1 runs the records of a batch one by one
+REKOGNITION_MAX_WORKERS = max(1, int(os.getenv('REKOGNITION_MAX_WORKERS', '10')))
+
+#XXX: stop starting Rekognition calls this long before the function times out,
+# to leave time for indexing the documents and reporting the rest as failures
+DEADLINE_MARGIN_MS = int(os.getenv('DEADLINE_MARGIN_MS', '30000'))
+
+#XXX: labels (and bounding boxes) below MIN_CONFIDENCE are neither returned by Rekognition nor indexed
+MAX_LABELS = int(os.getenv('MAX_LABELS', '10'))
+MIN_CONFIDENCE = float(os.getenv('MIN_CONFIDENCE', '55'))
+#XXX: the box centers are indexed as cells of a BOX_GRID x BOX_GRID grid
+BOX_GRID = int(os.getenv('BOX_GRID', '4'))
+
+#XXX: Rekognition detectors run on every image, concurrently: labels, text, moderation, faces
+DETECTORS = [name.strip() for name in os.getenv('DETECTORS', 'labels').split(',') if name.strip()]
+#XXX: faces are only detected in images with this label; set it empty to detect them in every image
+FACES_REQUIRED_LABEL = os.getenv('FACES_REQUIRED_LABEL', 'Person')
+
+#XXX: send a downscaled JPEG of large images instead of letting Rekognition read the original (needs Pillow)
+PREPROCESS_IMAGES = (os.getenv('PREPROCESS_IMAGES', 'false') == 'true')
+PREPROCESS_MAX_EDGE = int(os.getenv('PREPROCESS_MAX_EDGE', '1920'))
+PREPROCESS_MIN_OBJECT_BYTES = int(os.getenv('PREPROCESS_MIN_OBJECT_BYTES', str(1024 * 1024)))
+PREPROCESS_JPEG_QUALITY = int(os.getenv('PREPROCESS_JPEG_QUALITY', '85'))
+IMAGE_FETCH_MAX_OBJECT_BYTES = int(os.getenv('IMAGE_FETCH_MAX_OBJECT_BYTES', str(100 * 1024 * 1024)))
+
+#XXX: reuse the labels of an already tagged image whose perceptual hash is within
+# NEAR_DUP_RADIUS bits (out of 64) instead of calling Rekognition (needs Pillow)
+NEAR_DUP_ENABLED = (os.getenv('NEAR_DUP_ENABLED', 'false') == 'true')
+NEAR_DUP_RADIUS = int(os.getenv('NEAR_DUP_RADIUS', '6'))
+#XXX: only the hash and doc_id of an image are kept (about 400 bytes), and the labels of the last
+# NEAR_DUP_RECENT_LABELS; those of the others are fetched from the index on a match
+NEAR_DUP_MAX_ENTRIES = int(os.getenv('NEAR_DUP_MAX_ENTRIES', '20000'))
+NEAR_DUP_RECENT_LABELS = int(os.getenv('NEAR_DUP_RECENT_LABELS', '1024'))
+#XXX: load the hashes of the most recent documents from the index on the first invocation
+NEAR_DUP_REBUILD_ON_START = (os.getenv('NEAR_DUP_REBUILD_ON_START', 'true') == 'true')
+NEAR_DUP_REBUILD_MAX_DOCS = int(os.getenv('NEAR_DUP_REBUILD_MAX_DOCS', '20000'))
+
+# images are only decoded this large when they are hashed but not sent to Rekognition
+NEAR_DUP_DECODE_MAX_EDGE = 256
+
+#XXX: keep the calls near the account TPS limit of Rekognition and back off when throttled
+REKOGNITION_MAX_TPS = float(os.getenv('REKOGNITION_MAX_TPS', '50'))
+REKOGNITION_MIN_TPS = float(os.getenv('REKOGNITION_MIN_TPS', '1'))
+REKOGNITION_MAX_ATTEMPTS = int(os.getenv('REKOGNITION_MAX_ATTEMPTS', '8'))
+
+#XXX: label cache keyed by the S3 ETag; set LABEL_CACHE_SIZE=0 without any shared tier to disable it
+LABEL_CACHE_SIZE = int(os.getenv('LABEL_CACHE_SIZE', '1024'))
+LABEL_CACHE_TABLE = os.getenv('LABEL_CACHE_TABLE')
+LABEL_CACHE_SQLITE_PATH = os.getenv('LABEL_CACHE_SQLITE_PATH')
+LABEL_CACHE_TTL_SECONDS = int(os.getenv('LABEL_CACHE_TTL_SECONDS', str(30 * 24 * 60 * 60)))
+
+STAGE_NAMES = ('labels', 'text', 'moderation', 'faces')
+
+for _name in [name for name in DETECTORS if name not in STAGE_NAMES]:
+  print('[WARN] unknown detector ignored:', _name, file=sys.stderr)
+  DETECTORS.remove(_name)
+
+for _name in [name for name in ROLLUP_GRANULARITIES if name not in BUCKET_FORMATS]:
+  print('[WARN] unknown rollup granularity ignored:', _name, file=sys.stderr)
+  ROLLUP_GRANULARITIES.remove(_name)
+
 session = boto3.Session(region_name=AWS_REGION)
-credentials = session.get_credentials()
-credentials = credentials.get_frozen_credentials()
-access_key = credentials.access_key
-secret_key = credentials.secret_key
-token = credentials.token
-
-aws_auth = AWS4Auth(
-  access_key,
-  secret_key,
-  AWS_REGION,
-  'es',
-  session_token=token
-)
 
-es_client = Elasticsearch(
-  hosts = [{'host': ES_HOST, 'port': 443}],
-  http_auth=aws_auth,
-  use_ssl=True,
-  verify_certs=True,
-  connection_class=RequestsHttpConnection
-)
-print('[INFO] ElasticSearch Service', json.dumps(es_client.info(), indent=2), file=sys.stderr)
+# a single client shared by all the worker threads, with a connection pool large enough for them
+# botocore does not retry, so that the rate limiter sees every throttle; it retries the transient errors too
+rekognition_client = session.client('rekognition',
+  config=Config(max_pool_connections=REKOGNITION_MAX_WORKERS * max(1, len(DETECTORS)),
+    retries={'mode': 'standard', 'max_attempts': 1}))
+s3_client = session.client('s3',
+  config=Config(max_pool_connections=REKOGNITION_MAX_WORKERS))
+
+# shared by warm invocations, so the rate learned in a batch carries over to the next one
+# one per API, because Rekognition applies its TPS limits per API
+rekognition_rate_limiters = {name: AdaptiveRateLimiter(REKOGNITION_MAX_TPS, min_rate=REKOGNITION_MIN_TPS)
+  for name in STAGE_NAMES}
+
+# runs the detectors of an image other than `labels`, which runs on the image's own worker thread
+_executor_stages = [name for name in DETECTORS if name != 'labels']
+stage_executor = ThreadPoolExecutor(max_workers=REKOGNITION_MAX_WORKERS * len(_executor_stages)) \
+  if _executor_stages else None
+
+metrics = StageMetrics(METRICS_NAMESPACE, 'ImageAutoTagger')
+
+dead_letter_spool = create_spool(DEAD_LETTER_SPOOL, session)
+
+if PREPROCESS_IMAGES and not image_preprocessor.is_available():
+  print('[WARN] PREPROCESS_IMAGES is set but Pillow is not installed, images are sent as S3 objects', file=sys.stderr)
+if NEAR_DUP_ENABLED and not image_preprocessor.is_available():
+  print('[WARN] NEAR_DUP_ENABLED is set but Pillow is not installed, near-duplicates are not detected', file=sys.stderr)
+
+# persists between warm invocations; rebuilt from the index on the first one
+near_dup_index = NearDuplicateIndex(max_entries=NEAR_DUP_MAX_ENTRIES, recent_labels=NEAR_DUP_RECENT_LABELS) \
+  if NEAR_DUP_ENABLED and image_preprocessor.is_available() else None
+_near_dup_index_loaded = False
+
+# None until the index is bootstrapped; False when ES_INDEX is a concrete index that can not roll over
+_index_is_alias = None
+_rollover_checked_at = None
+
+# created on first use, so that a cold start does not pay for the connection setup
+_es_client = None
+_bulk_indexer = None
+_es_client_lock = threading.Lock()
+
+
+def _get_bulk_indexer():
+  global _es_client, _bulk_indexer
+
+  if _bulk_indexer is None:
+    with _es_client_lock:
+      if _bulk_indexer is None:
+        _es_client = create_es_client(ES_HOST, session, AWS_REGION)
+        _bulk_indexer = BulkIndexer(_es_client,
+          max_chunk_docs=int(os.getenv('BULK_MAX_CHUNK_DOCS', '500')),
+          max_chunk_bytes=int(os.getenv('BULK_MAX_CHUNK_BYTES', str(5 * 1024 * 1024))),
+          max_retries=int(os.getenv('BULK_MAX_RETRIES', '3')))
+  return _bulk_indexer
+
+
+def _prepare_index():
+  global _index_is_alias, _rollover_checked_at
+
+  if not INDEX_BOOTSTRAP:
+    return
+  _get_bulk_indexer()
+  try:
+    if _index_is_alias is None:
+      with metrics.timer('index_bootstrap'):
+        _index_is_alias = index_bootstrap.bootstrap(_es_client, ES_INDEX,
+          number_of_shards=INDEX_SHARDS,
+          number_of_replicas=INDEX_REPLICAS,
+          refresh_interval=INDEX_REFRESH_INTERVAL)
+        if ROLLUP_GRANULARITIES:
+          index_bootstrap.put_rollup_index_template(_es_client, ROLLUP_INDEX,
+            number_of_replicas=INDEX_REPLICAS)
+      _rollover_checked_at = time.monotonic()
+    elif _index_is_alias and time.monotonic() - _rollover_checked_at >= INDEX_ROLLOVER_CHECK_SECONDS:
+      _rollover_checked_at = time.monotonic()
+      with metrics.timer('index_rollover'):
+        index_bootstrap.rollover(_es_client, ES_INDEX,
+          max_age=INDEX_ROLLOVER_MAX_AGE,
+          max_docs=INDEX_ROLLOVER_MAX_DOCS,
+          max_size=INDEX_ROLLOVER_MAX_SIZE,
+          number_of_shards=INDEX_SHARDS,
+          number_of_replicas=INDEX_REPLICAS,
+          refresh_interval=INDEX_REFRESH_INTERVAL)
+  except Exception:
+    # tried again on the next invocation; documents wait until the write alias exists (see lambda_handler)
+    traceback.print_exc()
+
+
+def _requires_alias():
+  """Whether the documents must be written through the write alias, rather than let the first one create `ES_INDEX`."""
+  return INDEX_BOOTSTRAP and _index_is_alias is not False
+
+
+def _index_rollups(docs):
+  """Add the tags of the newly indexed documents to the rollup counts."""
+  try:
+    actions = rollup_actions(rollup_counts(docs, ROLLUP_GRANULARITIES), ROLLUP_INDEX)
+    if not actions:
+      return
+    result = _get_bulk_indexer().index(actions)
+  except Exception as ex:
+    traceback.print_exc()
+    metrics.add_error('rollup_index', ex)
+    return
+  for chunk in result.chunks:
+    metrics.add_latency('rollup_index', chunk['elapsed_ms'])
+  for failure in result.failed:
+    metrics.add_error('rollup_index', failure['error'].get('type', 'unknown'))
+    print('[ERROR] failed to update rollup', actions[failure['index']][0]['update']['_id'],
+      failure['status'], json.dumps(failure['error']), file=sys.stderr)
+
+
+def _load_near_dup_index():
+  global _near_dup_index_loaded
+
+  if near_dup_index is None or _near_dup_index_loaded:
+    return
+  _near_dup_index_loaded = True
+  if not NEAR_DUP_REBUILD_ON_START:
+    return
+  _get_bulk_indexer()
+  try:
+    with metrics.timer('near_dup_rebuild'):
+      count = near_dup_index.rebuild(_es_client, ES_INDEX, max_docs=NEAR_DUP_REBUILD_MAX_DOCS)
+    print('[INFO] near-duplicate index loaded:', count, file=sys.stderr)
+  except Exception as ex:
+    traceback.print_exc()
+    metrics.add_error('near_dup_rebuild', ex)
+
+
+def _near_dup_labels(doc_id):
+  """Return the labels of the near-duplicate from the index, or None if they can not be read."""
+  try:
+    _get_bulk_indexer()
+    return fetch_labels(_es_client, ES_INDEX, doc_id)
+  except Exception as ex:
+    traceback.print_exc()
+    metrics.add_error('near_dup', ex)
+    return None
+
+
+def _create_label_cache():
+  if LABEL_CACHE_TABLE:
+    shared_store = DynamoDBLabelStore(LABEL_CACHE_TABLE,
+      session.client('dynamodb',
+        config=Config(max_pool_connections=REKOGNITION_MAX_WORKERS)),
+      ttl_seconds=LABEL_CACHE_TTL_SECONDS)
+  elif LABEL_CACHE_SQLITE_PATH:
+    shared_store = SQLiteLabelStore(LABEL_CACHE_SQLITE_PATH)
+  else:
+    shared_store = None
+
+  if LABEL_CACHE_SIZE <= 0 and shared_store is None:
+    return None
+  return LabelCache(max_size=LABEL_CACHE_SIZE, shared_store=shared_store)
+
+# lives as long as the execution environment, so warm invocations share it
+label_cache = _create_label_cache()
+
+# doc_id -> content_id of the documents this function instance has indexed
+indexed_content_ids = LRUCache(INDEXED_CONTENT_ID_CACHE_SIZE)
+
+# replaces the document unless its content_id is unchanged, in which case nothing is written
+UPSERT_UNLESS_SAME_CONTENT_SCRIPT = '''
+if (ctx._source.content_id == params.doc.content_id) {
+  ctx.op = 'noop';
+} else {
+  ctx._source.clear();
+  ctx._source.putAll(params.doc);
+}'''.strip()
+
+
+class MalformedRecordError(Exception):
+  """The message can not be parsed, so retrying it would never succeed."""
 
 
 def _report_detected_labels(photo, response):
@@ -70,57 +355,478 @@ def _report_detected_labels(photo, response):
     print ()
 
 
-def lambda_handler(event, context):
-  doc_list = []
+def _deaggregate_records(records):
+  """Return the messages in the Kinesis records, and the index of the record each one came from.
 
-  for record in event['Records']:
+  KPL aggregated records are expanded into their user records;
+  a record whose data can not be decoded yields a single None message.
+  """
+  messages, message_records = [], []
+  for i, record in enumerate(records):
     try:
-      payload = base64.b64decode(record['kinesis']['data']).decode('utf-8')
-      json_data = json.loads(payload)
-
-      bucket, photo = (json_data['s3_bucket'], json_data['s3_key'])
-      rekognition_client = boto3.client('rekognition', region_name=AWS_REGION)
-
-      response = rekognition_client.detect_labels(Image={'S3Object':{'Bucket': bucket, 'Name': photo}},
-          MaxLabels=10)
-      #_report_detected_labels(photo, response)
-
-      lables = sorted([label['Name'] for label in response['Labels']])
-      tags = ', '.join(lables)
-      tag_id = hashlib.md5(tags.encode('utf-8')).hexdigest()[:8]
-
-      image_id = os.path.basename(photo)
-      doc = {
-        'doc_id': hashlib.md5(image_id.encode('utf-8')).hexdigest()[:8],
-        'image_id': image_id,
-        'image_url': S3_URL_FMT.format(bucket_name=bucket, object_key=photo),
-        #'tags': tags,
-        'tags': lables,
-        'tag_id': tag_id,
-        'created_at': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
-      }
-      #print('[INFO]', doc)
-
-      es_index_action_meta = {"index": {"_index": ES_INDEX, "_type": ES_TYPE, "_id": doc['doc_id']}}
-      doc_list.append(es_index_action_meta)
-      doc_list.append(doc)
+      user_records = deaggregate(base64.b64decode(record['kinesis']['data']))
+    except (IndexError, KeyError, TypeError, ValueError):
+      user_records = [(None, None)]
+    for _, message in user_records:
+      messages.append(message)
+      message_records.append(i)
+  return messages, message_records
+
+
+def _parse_message(message):
+  try:
+    json_data = json_codec.loads(message)
+    return (json_data['s3_bucket'], json_data['s3_key'], json_data.get('s3_etag'), json_data.get('s3_size'))
+  except (AttributeError, KeyError, TypeError, ValueError) as ex:
+    raise MalformedRecordError('{}: {}'.format(type(ex).__name__, ex)) from ex
+
+
+def _object_etag(bucket, photo, etag=None):
+  if not etag:
+    etag = s3_client.head_object(Bucket=bucket, Key=photo)['ETag']
+  return etag.strip('"')
+
+
+def _load_image(bucket, photo, size=None):
+  """Return the object bytes and the decoded image, or (None, None) when it is not fetched."""
+  # every image is hashed, but only the large ones are worth downscaling
+  min_object_bytes = 0 if near_dup_index is not None else PREPROCESS_MIN_OBJECT_BYTES
+  max_edge = PREPROCESS_MAX_EDGE if PREPROCESS_IMAGES else NEAR_DUP_DECODE_MAX_EDGE
+
+  with metrics.timer('preprocess'):
+    data = image_preprocessor.fetch_object(s3_client, bucket, photo,
+      min_object_bytes=min_object_bytes, max_object_bytes=IMAGE_FETCH_MAX_OBJECT_BYTES, object_size=size)
+    if data is None:
+      return (None, None)
+    try:
+      return (data, image_preprocessor.decode(data, max_edge))
+    except image_preprocessor.DECODE_ERRORS as ex:
+      # Rekognition may still read the original from S3
+      print('[WARN] failed to decode {}: {}: {}'.format(photo, type(ex).__name__, ex), file=sys.stderr)
+      metrics.add_error('preprocess', ex)
+      return (data, None)
+
+
+def _rekognition_image(bucket, photo, data=None, img=None):
+  if PREPROCESS_IMAGES and img is not None and len(data) >= PREPROCESS_MIN_OBJECT_BYTES:
+    with metrics.timer('preprocess'):
+      image_bytes = image_preprocessor.rekognition_image_bytes(img, len(data),
+        jpeg_quality=PREPROCESS_JPEG_QUALITY)
+    if image_bytes is not None:
+      return {'Bytes': image_bytes}
+  return {'S3Object':{'Bucket': bucket, 'Name': photo}}
+
+
+def _text_fields(response):
+  lines = [text['DetectedText'] for text in response['TextDetections'] if text['Type'] == 'LINE']
+  return {'detected_text': lines}
+
+
+def _moderation_fields(response):
+  return {'moderation_labels': sorted({label['Name'] for label in response['ModerationLabels']})}
+
+
+def _faces_fields(response):
+  return {'face_count': len(response['FaceDetails'])}
+
+
+def _has_faces_required_label(labels):
+  return not FACES_REQUIRED_LABEL or any(label['Name'] == FACES_REQUIRED_LABEL for label in labels)
+
+
+# name: (Rekognition method, request parameters, document fields of the response, condition on the labels)
+STAGES = {
+  'labels': ('detect_labels', {'MaxLabels': MAX_LABELS, 'MinConfidence': MIN_CONFIDENCE}, None, None),
+  'text': ('detect_text', {}, _text_fields, None),
+  'moderation': ('detect_moderation_labels', {}, _moderation_fields, None),
+  'faces': ('detect_faces', {}, _faces_fields, _has_faces_required_label)
+}
+
+
+def _run_stage(name, photo, image, deadline=None):
+  method, params, _, _ = STAGES[name]
+  with metrics.timer('rekognition' if name == 'labels' else 'rekognition_' + name):
+    # no call (nor retry) is started past the deadline, so the function returns before timing out
+    response = rekognition_rate_limiters[name].call(getattr(rekognition_client, method),
+        Image=image,
+        max_attempts=REKOGNITION_MAX_ATTEMPTS,
+        deadline=deadline,
+        **params)
+  if name == 'labels' and should_log_verbose():
+    _report_detected_labels(photo, response)
+  return response
+
+
+def _is_retryable_error(ex):
+  """Whether a retry of the message may succeed; an invalid or missing image, for one, never will."""
+  return isinstance(ex, DeadlineExceededError) or is_throttling_error(ex) or is_transient_error(ex)
+
+
+def _run_stages(photo, image, labels=None, deadline=None):
+  """Run the enabled detectors on the image and return (labels, fields, failed_stages).
+
+  The detectors without a condition run concurrently with `labels` (skipped when
+  `labels` are given); the conditional ones start once the labels are known.
+  A detector that failed for good is listed in `failed_stages` and the results of
+  the others are kept; a throttled or transient failure is raised so that the message
+  is retried, and so is the failure of every detector.
+  """
+  futures = {}
+  for name in DETECTORS:
+    if name != 'labels' and STAGES[name][3] is None:
+      futures[name] = stage_executor.submit(_run_stage, name, photo, image, deadline)
+
+  errors = {}
+  ran_labels = labels is None and 'labels' in DETECTORS
+  if ran_labels:
+    try:
+      labels = _run_stage('labels', photo, image, deadline)['Labels']
     except Exception as ex:
-      traceback.print_exc()
+      errors['labels'] = ex
 
-  if not doc_list:
-    return
+  if labels is not None:
+    for name in DETECTORS:
+      condition = STAGES[name][3]
+      if condition is not None and condition(labels):
+        futures[name] = stage_executor.submit(_run_stage, name, photo, image, deadline)
+
+  fields = {}
+  for name, future in futures.items():
+    try:
+      fields.update(STAGES[name][2](future.result()))
+    except Exception as ex:
+      errors[name] = ex
+
+  retryable = [ex for ex in errors.values() if _is_retryable_error(ex)]
+  if retryable:
+    raise retryable[0]
+  if errors and len(errors) == len(futures) + int(ran_labels):
+    raise next(iter(errors.values()))
+  for name, ex in errors.items():
+    print('[WARN] {} failed for {}: {}: {}'.format(name, photo, type(ex).__name__, ex), file=sys.stderr)
+  return (labels or [], fields, sorted(errors))
+
+
+def _analyze_image(bucket, photo, etag=None, size=None, deadline=None):
+  """Return (labels, fields, failed_stages, phash, near_dup_of) of the image.
+
+  The labels come from the label cache, from a near-duplicate already tagged
+  (`near_dup_of` is then its doc_id) or from Rekognition; `fields` are the document
+  fields of the other detectors. `phash` is None unless the image was hashed.
+  """
+  labels, cache_key = (None, None)
+  if label_cache is not None and 'labels' in DETECTORS:
+    with metrics.timer('label_cache'):
+      cache_key = 'labels:{}:{}:{}'.format(MAX_LABELS, MIN_CONFIDENCE, _object_etag(bucket, photo, etag))
+      labels = label_cache.get(cache_key)
+    if labels is not None and len(DETECTORS) == 1:
+      return (labels, {}, [], None, None)
+
+  detect_near_dups = near_dup_index is not None and labels is None and 'labels' in DETECTORS
+  data, img = (None, None)
+  if (PREPROCESS_IMAGES or detect_near_dups) and image_preprocessor.is_available():
+    data, img = _load_image(bucket, photo, size)
+
+  phash, near_dup_of = (None, None)
+  if detect_near_dups and img is not None:
+    with metrics.timer('near_dup'):
+      phash = dhash(img)
+      match = near_dup_index.nearest(phash, NEAR_DUP_RADIUS)
+      if match is not None:
+        _, doc_id, labels = match
+        if labels is None:
+          labels = _near_dup_labels(doc_id)
+        # tagged by Rekognition if the labels of the near-duplicate are not found
+        near_dup_of = doc_id if labels is not None else None
+
+  known_labels = labels
+  image = _rekognition_image(bucket, photo, data, img)
+  labels, fields, failed_stages = _run_stages(photo, image, labels=known_labels, deadline=deadline)
+
+  if cache_key is not None and known_labels is None and 'labels' not in failed_stages:
+    label_cache.put(cache_key, labels)
+  return (labels, fields, failed_stages, phash, near_dup_of)
+
+
+def _content_id(doc):
+  """Return a hash of everything indexed about the image but the time it was indexed at."""
+  content = {name: value for name, value in doc.items() if name != 'created_at'}
+  return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _build_doc(bucket, photo, labels, fields=None, failed_stages=None, phash=None, near_dup_of=None):
+  # labels from the cache or a near-duplicate may have been detected with another policy
+  labels = select_labels(labels, min_confidence=MIN_CONFIDENCE, max_labels=MAX_LABELS)
+  fields = dict(label_fields(labels, min_confidence=MIN_CONFIDENCE, grid=BOX_GRID), **(fields or {}))
+  tags = ', '.join(fields['tags'])
+  tag_id = hashlib.md5(tags.encode('utf-8')).hexdigest()[:8]
 
+  image_id = os.path.basename(photo)
+  doc = {
+    'doc_id': hashlib.sha256('{}/{}'.format(bucket, photo).encode('utf-8')).hexdigest(),
+    'image_id': image_id,
+    'image_url': S3_URL_FMT.format(bucket_name=bucket, object_key=photo),
+    'tag_id': tag_id,
+    'created_at': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+  }
+  # tags, tag_confidence, tag_instances, instance_count, boxes, box_cells
+  # and the fields of the other detectors
+  doc.update(fields)
+  if failed_stages:
+    doc['failed_stages'] = failed_stages
+  if phash is not None:
+    doc['phash'] = format_hash(phash)
+  if near_dup_of is not None:
+    doc['near_dup_of'] = near_dup_of
+  doc['content_id'] = _content_id(doc)
+  #print('[INFO]', doc)
+  return doc
+
+
+def _tag_image(message, deadline=None):
+  with metrics.timer('decode'):
+    bucket, photo, etag, size = _parse_message(message)
+  if deadline is not None and time.monotonic() >= deadline:
+    raise DeadlineExceededError(photo)
+  labels, fields, failed_stages, phash, near_dup_of = _analyze_image(bucket, photo, etag, size, deadline)
+  with metrics.timer('build'):
+    doc = _build_doc(bucket, photo, labels, fields=fields, failed_stages=failed_stages,
+      phash=phash, near_dup_of=near_dup_of)
+  # only the originals are added, so that a chain of small edits does not drift away from them
+  if phash is not None and near_dup_of is None and 'labels' not in failed_stages:
+    near_dup_index.add(phash, doc['doc_id'], labels)
+  return doc
+
+
+def _try_tag_image(message, deadline=None):
   try:
-    es_bulk_body = '\n'.join([json.dumps(e) for e in doc_list])
-    res = es_client.bulk(body=es_bulk_body, index=ES_INDEX, refresh=True)
+    return (_tag_image(message, deadline), None)
+  except DeadlineExceededError as ex:
+    return (None, ex)
   except Exception as ex:
     traceback.print_exc()
+    return (None, ex)
+
+
+def tag_images(messages, max_workers=REKOGNITION_MAX_WORKERS, deadline=None):
+  """Run label detection for the messages with at most `max_workers` concurrent calls.
+
+  Returns a list of (doc, error) tuples in the same order as `messages`;
+  a message that failed has `doc` set to None and its own exception as `error`.
+  Messages not started before `deadline` (a `time.monotonic()` value) fail with `DeadlineExceededError`,
+  and so do the started ones whose Rekognition calls or retries would go past it.
+  """
+  tag_image = functools.partial(_try_tag_image, deadline=deadline)
+  if max_workers <= 1 or len(messages) <= 1:
+    return [tag_image(message) for message in messages]
+
+  with ThreadPoolExecutor(max_workers=min(max_workers, len(messages))) as executor:
+    return list(executor.map(tag_image, messages))
+
+
+def _deadline(context):
+  get_remaining_time_in_millis = getattr(context, 'get_remaining_time_in_millis', None)
+  if get_remaining_time_in_millis is None:
+    return None
+  return time.monotonic() + (get_remaining_time_in_millis() - DEADLINE_MARGIN_MS) / 1000
+
+
+def _existing_docs(doc_ids):
+  """Return doc_id -> (index, content_id) of the documents already in one of the indices of ES_INDEX.
+
+  An upsert through the write alias only sees the write index, so after a rollover it
+  would add a second copy of a document of an older index; that one is updated in place instead.
+  Documents written within the refresh interval are not found, but they are in the write index.
+  """
+  if not doc_ids:
+    return {}
+  # room for the copies left by a rollover before the documents were looked up
+  response = _get_bulk_indexer().es_client.search(index=ES_INDEX, size=2 * len(doc_ids), body={
+    'query': {'terms': {'doc_id': doc_ids}},
+    '_source': ['doc_id', 'content_id']
+  })
+  existing = {}
+  # the newest index wins; their names end with the date and generation of the rollover
+  for hit in sorted(response['hits']['hits'], key=lambda hit: hit['_index']):
+    existing[hit['_source']['doc_id']] = (hit['_index'], hit['_source'].get('content_id'))
+  return existing
+
+
+def _index_action(doc, index=None):
+  """Return the bulk action that writes the document unless the index has it with the same content_id.
+
+  `index` is the index that already has the document, if any; new documents go through ES_INDEX.
+  """
+  action_meta = {"update": {"_index": index or ES_INDEX, "_id": doc['doc_id'], "retry_on_conflict": 3}}
+  if index is None and _requires_alias():
+    # an index auto-created under the alias name would keep the alias, and rollover, from ever being created
+    action_meta['update']['require_alias'] = True
+  source = {
+    "script": {"source": UPSERT_UNLESS_SAME_CONTENT_SCRIPT, "lang": "painless", "params": {"doc": doc}},
+    "upsert": doc
+  }
+  return (action_meta, source)
+
+
+def _dead_letter(stage, error, message, record, error_class=None):
+  """Return the dead-letter entry of a message, with the stream message as its payload if it parses."""
+  try:
+    payload = json_codec.loads(message)
+  except (TypeError, ValueError):
+    payload = None
+  if not isinstance(payload, dict):
+    raw = message if message is not None else record['kinesis'].get('data')
+    return dead_letter_entry('ImageAutoTagger', stage, error, raw=raw, error_class=error_class)
+  return dead_letter_entry('ImageAutoTagger', stage, error, payload=payload, error_class=error_class)
+
+
+def _is_retryable_index_failure(failure):
+  status = failure['status']
+  return status is None or status == 429 or status >= 500
+
+
+def lambda_handler(event, context):
+  """Tag the images of a Kinesis batch and index them.
+
+  Returns the sequence numbers of the records to retry as `batchItemFailures`
+  (the event source mapping must enable `ReportBatchItemFailures`): the ones that
+  were throttled, failed transiently or were not started before the deadline.
+  Malformed records, images that can not be tagged (e.g. an invalid image format)
+  and documents rejected by the index for good are dropped, and go to the dead-letter
+  spool. The records still failing once their retries are used up are sent by the
+  event source mapping to its on-failure destination instead.
+  """
+  records = event['Records']
+  failed_records = set()
+
+  # a KPL aggregated record is retried as a whole if any of its messages failed
+  messages, message_records = _deaggregate_records(records)
+
+  _prepare_index()
+  _load_near_dup_index()
+
+  docs, doc_records, doc_messages, dead_letters = [], [], [], []
+  skipped, malformed, rejected, near_dups, unchanged = 0, 0, 0, 0, 0
+  for j, (doc, error) in enumerate(tag_images(messages, deadline=_deadline(context))):
+    i = message_records[j]
+    if doc is None:
+      if isinstance(error, DeadlineExceededError):
+        skipped += 1
+      if isinstance(error, MalformedRecordError):
+        malformed += 1
+        dead_letters.append((i, _dead_letter('decode', error, messages[j], records[i])))
+      elif _is_retryable_error(error):
+        failed_records.add(i)
+      else:
+        # retrying it, and every later record of the shard with it, would fail the same way
+        rejected += 1
+        dead_letters.append((i, _dead_letter('tag_image', error, messages[j], records[i])))
+      continue
+    if 'near_dup_of' in doc:
+      near_dups += 1
+    if indexed_content_ids.get(doc['doc_id']) == doc['content_id']:
+      # re-processed (e.g. a replayed record) without any change
+      unchanged += 1
+      continue
+    docs.append(doc)
+    doc_records.append(i)
+    doc_messages.append(j)
+
+  if skipped:
+    print('[WARN] deadline reached, messages left for retry:', skipped, file=sys.stderr)
+  if label_cache is not None:
+    print('[INFO] label cache', json.dumps(label_cache.stats()), file=sys.stderr)
+  rate_limiter_stats = {name: rekognition_rate_limiters[name].stats() for name in DETECTORS}
+  print('[INFO] rekognition rate limiters', json.dumps(rate_limiter_stats), file=sys.stderr)
+
+  existing = {}
+  if docs and INDEX_BOOTSTRAP and _index_is_alias is None:
+    print('[WARN] the write alias {} is not created yet, documents left for retry:'.format(ES_INDEX),
+      len(docs), file=sys.stderr)
+    metrics.add_error('bulk_index', 'WriteAliasMissing')
+    failed_records.update(doc_records)
+    docs = []
+  elif docs:
+    try:
+      with metrics.timer('existing_docs'):
+        existing = _existing_docs([doc['doc_id'] for doc in docs])
+    except Exception:
+      # written without it, an image of an older index could be indexed, and counted, twice
+      traceback.print_exc()
+      failed_records.update(doc_records)
+      docs = []
+
+  es_actions, action_records, action_messages = [], [], []
+  for doc, i, j in zip(docs, doc_records, doc_messages):
+    index, content_id = existing.get(doc['doc_id'], (None, None))
+    if content_id == doc['content_id']:
+      unchanged += 1
+      indexed_content_ids.put(doc['doc_id'], content_id)
+      continue
+    es_actions.append(_index_action(doc, index))
+    action_records.append(i)
+    action_messages.append(j)
+
+  if es_actions:
+    try:
+      result = _get_bulk_indexer().index(es_actions)
+    except Exception as ex:
+      traceback.print_exc()
+      metrics.add_error('bulk_index', ex)
+      failed_records.update(action_records)
+    else:
+      for chunk in result.chunks:
+        metrics.add_latency('bulk_index', chunk['elapsed_ms'])
+        if should_log_verbose():
+          print('[INFO] bulk chunk', json.dumps(chunk), file=sys.stderr)
+      for failure in result.failed:
+        metrics.add_error('bulk_index', failure['error'].get('type', 'unknown'))
+        doc = es_actions[failure['index']][1]['upsert']
+        print('[ERROR] failed to index', doc['image_url'], failure['status'], json.dumps(failure['error']), file=sys.stderr)
+        if _is_retryable_index_failure(failure):
+          failed_records.add(action_records[failure['index']])
+        else:
+          i = action_records[failure['index']]
+          dead_letters.append((i, _dead_letter('bulk_index',
+            '{} {}'.format(failure['status'], failure['error'].get('reason', '')),
+            messages[action_messages[failure['index']]], records[i],
+            error_class=failure['error'].get('type', 'unknown'))))
+      for (_, source), item in zip(es_actions, result.items):
+        if item.get('result') == 'noop':
+          unchanged += 1
+        if 'error' not in item:
+          indexed_content_ids.put(source['upsert']['doc_id'], source['upsert']['content_id'])
+      if ROLLUP_GRANULARITIES:
+        # only count the documents seen for the first time, not the ones of a retried record
+        _index_rollups([source['upsert'] for (_, source), item in zip(es_actions, result.items)
+          if item.get('result') == 'created'])
+
+  metrics.put_metric('RecordsReceived', len(records))
+  metrics.put_metric('MessagesReceived', len(messages))
+  metrics.put_metric('MessagesMalformed', malformed)
+  metrics.put_metric('MessagesDeadlineSkipped', skipped)
+  metrics.put_metric('MessagesRejected', rejected)
+  metrics.put_metric('NearDuplicates', near_dups)
+  metrics.put_metric('DocumentsUnchanged', unchanged)
+  # a record that is retried comes back whole, including its messages that failed for good
+  dead_letters = [entry for i, entry in dead_letters if i not in failed_records]
+  write_dead_letters(dead_letter_spool, dead_letters)
+
+  metrics.put_metric('RecordsFailed', len(failed_records))
+  metrics.put_metric('DeadLetters', len(dead_letters))
+  for name in DETECTORS:
+    metrics.put_metric('RekognitionRate' if name == 'labels' else 'RekognitionRate.' + name,
+      rate_limiter_stats[name]['rate'], 'Count/Second')
+  metrics.flush()
+
+  return {'batchItemFailures': [{'itemIdentifier': records[i]['kinesis']['sequenceNumber']}
+    for i in sorted(failed_records)]}
 
 
 if __name__ == "__main__":
     kinesis_data = [
       '''{"s3_bucket": "november-photo", "s3_key": "raw-image/20191119_170325.jpg"}''',
-      '''{"s3_bucket": "november-photo", "s3_key": "raw-image/20191120_122332.jpg"}''',
+      '''{"s3_bucket": "november-photo", "s3_key": "raw-image/20191120_122332.jpg", "s3_etag": "bca44a2aac2c789bc77b5eb13bcb04e2", "s3_size": 4300}''',
     ]
 
     records = [{
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import io
+
+try:
+  from PIL import Image, ImageOps
+  # UnidentifiedImageError and truncated images are OSErrors
+  DECODE_ERRORS = (OSError, Image.DecompressionBombError)
+except ImportError:
+  Image = ImageOps = None
+  DECODE_ERRORS = (OSError,)
+
+# Rekognition accepts up to 5 MB of image bytes and up to 15 MB from S3
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+MAX_S3_OBJECT_BYTES = 15 * 1024 * 1024
+
+_READ_CHUNK_SIZE = 1024 * 1024
+
+
+def is_available():
+  return Image is not None
+
+
+def _in_range(object_size, min_object_bytes, max_object_bytes):
+  return min_object_bytes <= object_size <= max_object_bytes
+
+
+def fetch_object(s3_client, bucket, key, min_object_bytes=0, max_object_bytes=100 * 1024 * 1024, object_size=None):
+  """Stream the S3 object into memory, or return None if its size is out of the given range.
+
+  The size is checked before the object is fetched: `object_size` if known (e.g. from
+  the S3 event), or else from a HeadObject call.
+  """
+  if object_size is None:
+    object_size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+  if not _in_range(object_size, min_object_bytes, max_object_bytes):
+    return None
+
+  response = s3_client.get_object(Bucket=bucket, Key=key)
+  body = response['Body']
+  try:
+    # the object may have been replaced since its size was taken
+    if not _in_range(response.get('ContentLength', 0), min_object_bytes, max_object_bytes):
+      return None
+
+    buf = io.BytesIO()
+    while True:
+      chunk = body.read(_READ_CHUNK_SIZE)
+      if not chunk:
+        break
+      buf.write(chunk)
+      if buf.tell() > max_object_bytes:
+        return None
+    return buf.getvalue()
+  finally:
+    body.close()
+
+
+def decode(data, max_edge):
+  """Decode the image, apply its EXIF orientation and fit it into `max_edge` pixels.
+
+  Raises one of DECODE_ERRORS if the image can not be decoded.
+  """
+  img = Image.open(io.BytesIO(data))
+  # lets the JPEG decoder scale down by a power of 2 while decoding, which is much cheaper
+  img.draft('RGB', (max_edge, max_edge))
+  # decoding is lazy: fail here rather than while re-encoding the image
+  img.load()
+  img = ImageOps.exif_transpose(img)
+  if img.mode != 'RGB':
+    img = img.convert('RGB')
+  if max(img.size) > max_edge:
+    img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+  return img
+
+
+def encode_jpeg(img, jpeg_quality=85):
+  out = io.BytesIO()
+  img.save(out, format='JPEG', quality=jpeg_quality)
+  return out.getvalue()
+
+
+def rekognition_image_bytes(img, original_size, jpeg_quality=85):
+  """Return the JPEG bytes of the decoded image to send to Rekognition, or None to pass the S3 object.
+
+  The re-encoded image is only used when it is smaller than the original (or the
+  original is too large for Rekognition to read from S3) and fits into the `Bytes` limit.
+  """
+  image_bytes = encode_jpeg(img, jpeg_quality)
+  if len(image_bytes) > MAX_IMAGE_BYTES:
+    return None
+  if len(image_bytes) >= original_size and original_size <= MAX_S3_OBJECT_BYTES:
+    return None
+  return image_bytes
+
+
+if __name__ == '__main__':
+  import random
+
+  class StubS3:
+
+    def __init__(self, data):
+      self.data = data
+      self.gets = 0
+
+    def head_object(self, Bucket, Key):
+      return {'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key):
+      self.gets += 1
+      return {'Body': io.BytesIO(self.data), 'ContentLength': len(self.data)}
+
+  def png(img):
+    out = io.BytesIO()
+    img.save(out, format='PNG')
+    return out.getvalue()
+
+  rng = random.Random(0)
+  noise = Image.frombytes('RGB', (1000, 800), bytes(rng.getrandbits(8) for _ in range(1000 * 800 * 3)))
+  data = png(noise)
+  assert fetch_object(StubS3(data), 'bucket', 'key') == data
+  assert fetch_object(StubS3(data), 'bucket', 'key', min_object_bytes=len(data) + 1) is None
+  assert fetch_object(StubS3(data), 'bucket', 'key', max_object_bytes=len(data) - 1) is None
+  # the objects out of range are not fetched at all
+  s3 = StubS3(data)
+  assert fetch_object(s3, 'bucket', 'key', min_object_bytes=len(data) + 1) is None and s3.gets == 0
+  assert fetch_object(s3, 'bucket', 'key', max_object_bytes=len(data) - 1, object_size=len(data)) is None and s3.gets == 0
+  assert fetch_object(s3, 'bucket', 'key', object_size=len(data)) == data and s3.gets == 1
+
+  img = decode(data, 500)
+  assert img.size == (500, 400) and img.mode == 'RGB', img
+  image_bytes = rekognition_image_bytes(img, len(data))
+  assert image_bytes is not None and len(image_bytes) < len(data)
+  # a re-encoded image no smaller than the original is not worth sending
+  assert rekognition_image_bytes(img, 1000) is None
+
+  exif = Image.Exif()
+  exif[0x0112] = 6  # rotated 90 degrees clockwise
+  out = io.BytesIO()
+  Image.new('RGB', (40, 20)).save(out, format='JPEG', exif=exif)
+  assert decode(out.getvalue(), 100).size == (20, 40)
+
+  for corrupt in (data[:len(data) // 2], b'not an image'):
+    try:
+      decode(corrupt, 500)
+      assert False, 'decoded a corrupt image'
+    except DECODE_ERRORS as ex:
+      print('corrupt image: {}: {}'.format(type(ex).__name__, ex))
+  print('preprocess: {} -> {} bytes'.format(len(data), len(image_bytes)))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+  """Thread-safe in-process LRU cache.
+
+  Kept at module level by the caller, so it survives warm invocations of the Lambda function.
+  """
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self._items = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      if key not in self._items:
+        return None
+      self._items.move_to_end(key)
+      return self._items[key]
+
+  def put(self, key, value):
+    if self.max_size <= 0:
+      return
+    with self._lock:
+      self._items[key] = value
+      self._items.move_to_end(key)
+      while len(self._items) > self.max_size:
+        self._items.popitem(last=False)
+
+  def __len__(self):
+    return len(self._items)
+
+
+class SQLiteLabelStore:
+  """Shared tier backed by a local SQLite file.
+
+  A stand-in for a shared store in tests and local runs; any object with
+  the same `get(key)` and `put(key, labels)` methods can be used instead.
+  """
+
+  def __init__(self, path):
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    self._lock = threading.Lock()
+    with self._lock, self._conn:
+      self._conn.execute('CREATE TABLE IF NOT EXISTS labels (cache_key TEXT PRIMARY KEY, labels TEXT, updated_at REAL)')
+
+  def get(self, key):
+    with self._lock:
+      row = self._conn.execute('SELECT labels FROM labels WHERE cache_key = ?', (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+  def put(self, key, labels):
+    with self._lock, self._conn:
+      self._conn.execute('INSERT OR REPLACE INTO labels (cache_key, labels, updated_at) VALUES (?, ?, ?)',
+        (key, json.dumps(labels), time.time()))
+
+
+class DynamoDBLabelStore:
+  """Shared tier backed by a DynamoDB table with a `cache_key` string hash key."""
+
+  def __init__(self, table_name, dynamodb_client, ttl_seconds=None):
+    self.table_name = table_name
+    self._client = dynamodb_client
+    self.ttl_seconds = ttl_seconds
+
+  def get(self, key):
+    res = self._client.get_item(TableName=self.table_name, Key={'cache_key': {'S': key}})
+    item = res.get('Item')
+    return json.loads(item['labels']['S']) if item else None
+
+  def put(self, key, labels):
+    item = {'cache_key': {'S': key}, 'labels': {'S': json.dumps(labels)}}
+    if self.ttl_seconds:
+      item['expire_at'] = {'N': str(int(time.time()) + self.ttl_seconds)}
+    self._client.put_item(TableName=self.table_name, Item=item)
+
+
+class LabelCache:
+  """Two-tier label cache keyed by object content (e.g. S3 ETag).
+
+  Lookups go to the in-process LRU tier first and then to the optional shared tier;
+  a shared tier hit is promoted into the LRU tier. Errors of the shared tier are
+  counted and treated as misses, so the cache can never fail a record.
+  """
+
+  def __init__(self, max_size=1024, shared_store=None):
+    self.local = LRUCache(max_size)
+    self.shared = shared_store
+    self._lock = threading.Lock()
+    self._stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'shared_errors': 0}
+
+  def _incr(self, name):
+    with self._lock:
+      self._stats[name] += 1
+
+  def get(self, key):
+    labels = self.local.get(key)
+    if labels is not None:
+      self._incr('local_hits')
+      return labels
+
+    if self.shared is not None:
+      try:
+        labels = self.shared.get(key)
+      except Exception:
+        self._incr('shared_errors')
+        labels = None
+      if labels is not None:
+        self._incr('shared_hits')
+        self.local.put(key, labels)
+        return labels
+
+    self._incr('misses')
+    return None
+
+  def put(self, key, labels):
+    self.local.put(key, labels)
+    if self.shared is not None:
+      try:
+        self.shared.put(key, labels)
+      except Exception:
+        self._incr('shared_errors')
+
+  def stats(self):
+    with self._lock:
+      stats = dict(self._stats)
+    lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+    stats['hit_ratio'] = (lookups - stats['misses']) / lookups if lookups else 0.0
+    stats['local_size'] = len(self.local)
+    return stats
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Compact document fields of the Rekognition labels.
+
+Every field is a flat array of keyword tokens or a number, so it can be filtered
+with `term`/`terms` and counted with a `terms` aggregation without nested documents:
+
+  tags            ["Car", "Person"]
+  tag_confidence  ["Car:99", "Person:97"]      confidence rounded down to an int
+  tag_instances   ["Car:2", "Person:1"]        only the labels with bounding boxes
+  instance_count  3
+  boxes           ["Car:12,55,31,22", ...]     left,top,width,height in % of the image
+  box_cells       ["Car:2:0", ...]             row:col of the box center in a grid of
+                                               `grid` x `grid` cells, e.g. "cars in the top half"
+"""
+
+import collections
+
+
+def select_labels(labels, min_confidence=0, max_labels=None):
+  """Return the labels with at least `min_confidence`, at most `max_labels` of them."""
+  selected = [label for label in labels if label.get('Confidence', 100) >= min_confidence]
+  return selected[:max_labels] if max_labels else selected
+
+
+def _percent(value):
+  return min(100, max(0, int(round(value * 100))))
+
+
+def label_fields(labels, min_confidence=0, grid=4):
+  names = set()
+  confidences = []
+  instance_counts = collections.OrderedDict()
+  boxes, box_cells = [], []
+  for label in labels:
+    name = label['Name']
+    names.add(name)
+    if 'Confidence' in label:
+      confidences.append('{}:{}'.format(name, int(label['Confidence'])))
+    for instance in label.get('Instances', []):
+      if instance.get('Confidence', 100) < min_confidence:
+        continue
+      box = instance['BoundingBox']
+      instance_counts[name] = instance_counts.get(name, 0) + 1
+      boxes.append('{}:{},{},{},{}'.format(name, _percent(box['Left']), _percent(box['Top']),
+        _percent(box['Width']), _percent(box['Height'])))
+      row = min(grid - 1, max(0, int((box['Top'] + box['Height'] / 2) * grid)))
+      col = min(grid - 1, max(0, int((box['Left'] + box['Width'] / 2) * grid)))
+      box_cells.append('{}:{}:{}'.format(name, row, col))
+
+  return {
+    'tags': sorted(names),
+    'tag_confidence': sorted(confidences),
+    'tag_instances': ['{}:{}'.format(name, count) for name, count in sorted(instance_counts.items())],
+    'instance_count': sum(instance_counts.values()),
+    'boxes': boxes,
+    'box_cells': sorted(set(box_cells))
+  }
+
+
+def labels_from_fields(source):
+  """Rebuild Rekognition-like labels from the fields of an indexed document.
+
+  Confidences are rounded down and each instance gets the confidence of its label.
+  """
+  confidences = {}
+  for token in source.get('tag_confidence', []):
+    name, _, confidence = token.rpartition(':')
+    confidences[name] = float(confidence)
+
+  instances = collections.defaultdict(list)
+  for token in source.get('boxes', []):
+    name, _, box = token.rpartition(':')
+    left, top, width, height = [int(value) / 100 for value in box.split(',')]
+    instances[name].append({
+      'BoundingBox': {'Left': left, 'Top': top, 'Width': width, 'Height': height},
+      'Confidence': confidences.get(name, 100.0)
+    })
+
+  labels = []
+  for name in source.get('tags', []):
+    label = {'Name': name, 'Instances': instances.get(name, []), 'Parents': []}
+    if name in confidences:
+      label['Confidence'] = confidences[name]
+    labels.append(label)
+  return labels
+
+
+if __name__ == '__main__':
+  labels = [
+    {'Name': 'Car', 'Confidence': 99.2, 'Instances': [
+      {'BoundingBox': {'Width': 0.31, 'Height': 0.22, 'Left': 0.12, 'Top': 0.55}, 'Confidence': 99.2},
+      {'BoundingBox': {'Width': 0.18, 'Height': 0.14, 'Left': 0.61, 'Top': 0.58}, 'Confidence': 45.7}
+    ], 'Parents': [{'Name': 'Vehicle'}]},
+    {'Name': 'Vehicle', 'Confidence': 99.2, 'Instances': [], 'Parents': []},
+    {'Name': 'Tree', 'Confidence': 50.0, 'Instances': [], 'Parents': []}
+  ]
+  fields = label_fields(select_labels(labels, min_confidence=55), min_confidence=55)
+  assert fields['tags'] == ['Car', 'Vehicle'], fields
+  assert fields['tag_instances'] == ['Car:1'] and fields['instance_count'] == 1, fields
+  assert fields['boxes'] == ['Car:12,55,31,22'] and fields['box_cells'] == ['Car:2:1'], fields
+  assert label_fields(labels_from_fields(fields)) == fields
+  print(fields)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import threading
+
+from label_cache import LRUCache
+from label_fields import labels_from_fields
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+
+def dhash(img, hash_size=8):
+  """Return the difference hash of a PIL image as an int of `hash_size` * `hash_size` bits.
+
+  Each bit tells whether a pixel of the downsized grayscale image is brighter than
+  its right neighbour, so the hash survives re-compression, resizing and small edits.
+  """
+  small = img.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+  pixels = list(small.getdata())
+  value = 0
+  for row in range(hash_size):
+    offset = row * (hash_size + 1)
+    for col in range(hash_size):
+      value = (value << 1) | (1 if pixels[offset + col] > pixels[offset + col + 1] else 0)
+  return value
+
+
+def hamming_distance(a, b):
+  return bin(a ^ b).count('1')
+
+
+def format_hash(value):
+  return '{:016x}'.format(value)
+
+
+def parse_hash(text):
+  return int(text, 16)
+
+
+class BKTree:
+  """Burkhard-Keller tree of hashes under the Hamming distance.
+
+  A search within `radius` only visits the children whose edge distance is within
+  `radius` of the distance to the current node (triangle inequality).
+  """
+
+  def __init__(self):
+    self._root = None
+    self._size = 0
+
+  def __len__(self):
+    return self._size
+
+  def add(self, key, value):
+    node = [key, value, {}]
+    self._size += 1
+    if self._root is None:
+      self._root = node
+      return
+    current = self._root
+    while True:
+      distance = hamming_distance(key, current[0])
+      child = current[2].get(distance)
+      if child is None:
+        current[2][distance] = node
+        return
+      current = child
+
+  def search(self, key, radius):
+    """Return the (distance, key, value) of every entry within `radius`, nearest first."""
+    if self._root is None:
+      return []
+    found = []
+    stack = [self._root]
+    while stack:
+      node = stack.pop()
+      distance = hamming_distance(key, node[0])
+      if distance <= radius:
+        found.append((distance, node[0], node[1]))
+      # a copy, since another thread may be adding a child
+      for edge, child in list(node[2].items()):
+        if distance - radius <= edge <= distance + radius:
+          stack.append(child)
+    return sorted(found, key=lambda e: e[0])
+
+
+class NearDuplicateIndex:
+  """Thread-safe perceptual hash index of the tagged images.
+
+  Kept at module level by the caller, so it persists between warm invocations.
+  Only the hashes and doc_ids are kept in the tree; the labels are only kept for the
+  `recent_labels` last added images, which may not be searchable in the index yet, and
+  are fetched from the index (`fetch_labels`) for the others.
+  When it reaches `max_entries` it starts over, since recent uploads are the most
+  likely to have near-duplicates (burst shots, re-uploads).
+  """
+
+  def __init__(self, max_entries=20000, recent_labels=1024):
+    self.max_entries = max_entries
+    self._tree = BKTree()
+    self._recent_labels = LRUCache(recent_labels)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._tree)
+
+  def add(self, phash, doc_id, labels):
+    self._recent_labels.put(doc_id, labels)
+    with self._lock:
+      if len(self._tree) >= self.max_entries:
+        self._tree = BKTree()
+      self._tree.add(phash, doc_id)
+
+  def nearest(self, phash, radius):
+    """Return (distance, doc_id, labels) of the nearest image within `radius`, or None.
+
+    `labels` is None unless the image is one of the recently added ones.
+    """
+    # the tree is only ever added to or replaced, so it is searched without holding the lock
+    found = self._tree.search(phash, radius)
+    if not found:
+      return None
+    distance, _, doc_id = found[0]
+    return (distance, doc_id, self._recent_labels.get(doc_id))
+
+  def rebuild(self, es_client, index, max_docs=20000, page_size=1000, scroll='2m'):
+    """Replace the entries with the most recent documents of `index` that have a `phash`."""
+    tree = BKTree()
+    response = es_client.search(index=index, scroll=scroll, size=page_size, body={
+      'query': {'exists': {'field': 'phash'}},
+      '_source': ['doc_id', 'phash'],
+      'sort': [{'created_at': {'order': 'desc'}}]
+    })
+    scroll_id = response.get('_scroll_id')
+    try:
+      while response['hits']['hits'] and len(tree) < max_docs:
+        for hit in response['hits']['hits'][:max_docs - len(tree)]:
+          source = hit['_source']
+          tree.add(parse_hash(source['phash']), source.get('doc_id', hit['_id']))
+        response = es_client.scroll(scroll_id=scroll_id, scroll=scroll)
+        scroll_id = response.get('_scroll_id', scroll_id)
+    finally:
+      if scroll_id:
+        try:
+          es_client.clear_scroll(scroll_id=scroll_id)
+        except Exception:
+          pass
+
+    with self._lock:
+      self._tree = tree
+    return len(tree)
+
+
+def fetch_labels(es_client, index, doc_id):
+  """Return the labels of the document `doc_id` of `index`, or None if it is not found.
+
+  A search rather than a get, since `index` may be an alias of several indices.
+  """
+  response = es_client.search(index=index, size=1, body={
+    'query': {'term': {'doc_id': doc_id}},
+    '_source': ['tags', 'tag_confidence', 'boxes']
+  })
+  hits = response['hits']['hits']
+  return labels_from_fields(hits[0]['_source']) if hits else None
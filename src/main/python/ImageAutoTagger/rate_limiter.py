@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import random
+import threading
+import time
+
+# connection errors and timeouts, of botocore if installed
+try:
+  from botocore.exceptions import ConnectionError as BotocoreConnectionError, HTTPClientError
+  TRANSIENT_EXCEPTIONS = (ConnectionError, TimeoutError, BotocoreConnectionError, HTTPClientError)
+except ImportError:
+  TRANSIENT_EXCEPTIONS = (ConnectionError, TimeoutError)
+
+THROTTLING_ERROR_CODES = (
+  'ThrottlingException',
+  'ProvisionedThroughputExceededException',
+  'TooManyRequestsException',
+  'RequestLimitExceeded',
+  'SlowDown'
+)
+
+# rounding leaves the refilled tokens a hair below 1.0, with a wait too short to move the clock
+_TOKEN_EPSILON = 1e-9
+
+TRANSIENT_ERROR_CODES = (
+  'InternalServerError',
+  'InternalFailure',
+  'ServiceUnavailable',
+  'ServiceUnavailableException',
+  'RequestTimeout',
+  'RequestTimeoutException'
+)
+
+
+class DeadlineExceededError(Exception):
+  """The call was not started, or not retried, because it would end past its deadline."""
+
+
+def is_throttling_error(ex):
+  response = getattr(ex, 'response', None) or {}
+  return response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def is_transient_error(ex):
+  """A server error or a failed connection, which the same call may not run into again."""
+  if isinstance(ex, TRANSIENT_EXCEPTIONS):
+    return True
+  response = getattr(ex, 'response', None) or {}
+  if response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES:
+    return True
+  return response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+
+
+class AdaptiveRateLimiter:
+  """Token bucket whose refill rate follows additive-increase/multiplicative-decrease.
+
+  Every successful call raises the rate so that it grows by about `increase_per_second`
+  calls/s for each second spent at full rate; a throttling response multiplies it by
+  `decrease_factor`, at most once per `decrease_cooldown` seconds so that the
+  throttles of one burst are counted as one congestion signal.
+  The bucket holds up to `burst_seconds` worth of tokens at the current rate.
+
+  Transient errors are retried after an exponential backoff with full jitter,
+  starting at `backoff_base` seconds and capped at `backoff_max`, without changing the rate.
+  A `deadline` (a value of `clock`) stops the waits and retries that would go past it
+  with DeadlineExceededError.
+  """
+
+  def __init__(self, max_rate, min_rate=1.0, initial_rate=None, increase_per_second=1.0,
+      decrease_factor=0.5, decrease_cooldown=1.0, burst_seconds=1.0,
+      backoff_base=0.1, backoff_max=5.0, clock=time.monotonic, sleep=time.sleep):
+    self.max_rate = float(max_rate)
+    self.min_rate = float(min_rate)
+    self.rate = float(initial_rate or max_rate)
+    self.increase_per_second = increase_per_second
+    self.decrease_factor = decrease_factor
+    self.decrease_cooldown = decrease_cooldown
+    self.burst_seconds = burst_seconds
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self._clock = clock
+    self._sleep = sleep
+    self._lock = threading.Lock()
+    self._tokens = 1.0
+    self._last_refill = clock()
+    self._last_decrease = None
+    self._stats = {'calls': 0, 'throttles': 0, 'transient_errors': 0, 'retries': 0, 'gave_up': 0, 'waited_ms': 0.0}
+
+  def _refill(self, now):
+    capacity = max(1.0, self.rate * self.burst_seconds)
+    self._tokens = min(capacity, self._tokens + (now - self._last_refill) * self.rate)
+    self._last_refill = now
+
+  def acquire(self, deadline=None):
+    """Block until a token is available and take it."""
+    while True:
+      with self._lock:
+        now = self._clock()
+        self._refill(now)
+        if self._tokens >= 1.0 - _TOKEN_EPSILON:
+          self._tokens -= 1.0
+          return
+        wait = (1.0 - self._tokens) / self.rate
+        if deadline is not None and now + wait >= deadline:
+          raise DeadlineExceededError('no token before the deadline')
+        self._stats['waited_ms'] += wait * 1000
+      self._sleep(wait)
+
+  def on_success(self):
+    with self._lock:
+      self._stats['calls'] += 1
+      self.rate = min(self.max_rate, self.rate + self.increase_per_second / self.rate)
+
+  def on_throttle(self):
+    with self._lock:
+      self._stats['throttles'] += 1
+      now = self._clock()
+      if self._last_decrease is None or now - self._last_decrease >= self.decrease_cooldown:
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self._tokens = min(self._tokens, 0.0)
+        self._last_decrease = now
+
+  def call(self, fn, *args, max_attempts=8, deadline=None, **kwargs):
+    """Call `fn` within the rate limit, retrying it while it is throttled or fails transiently."""
+    for attempt in range(max_attempts):
+      if attempt > 0:
+        with self._lock:
+          self._stats['retries'] += 1
+      if deadline is not None and self._clock() >= deadline:
+        raise DeadlineExceededError('attempt {} not started before the deadline'.format(attempt + 1))
+      self.acquire(deadline)
+      try:
+        result = fn(*args, **kwargs)
+      except Exception as ex:
+        if is_throttling_error(ex):
+          self.on_throttle()
+        elif is_transient_error(ex):
+          with self._lock:
+            self._stats['transient_errors'] += 1
+        else:
+          raise
+        if attempt + 1 == max_attempts:
+          with self._lock:
+            self._stats['gave_up'] += 1
+          raise
+        if not is_throttling_error(ex):
+          backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+          if deadline is not None and self._clock() + backoff >= deadline:
+            raise DeadlineExceededError('no retry before the deadline') from ex
+          self._sleep(backoff)
+      else:
+        self.on_success()
+        return result
+
+  def stats(self):
+    with self._lock:
+      stats = dict(self._stats)
+      stats['rate'] = round(self.rate, 3)
+    stats['waited_ms'] = round(stats['waited_ms'], 3)
+    return stats
+
+
+if __name__ == '__main__':
+
+  class FakeClock:
+
+    def __init__(self, now):
+      self.now = now
+
+    def __call__(self):
+      return self.now
+
+    def sleep(self, seconds):
+      self.now += seconds
+
+  class Throttled(Exception):
+    response = {'Error': {'Code': 'ThrottlingException'}}
+
+  class ThrottlingService:
+    """Throttles the calls beyond `capacity` within each second."""
+
+    def __init__(self, clock, capacity):
+      self.clock = clock
+      self.capacity = capacity
+      self.window, self.calls, self.throttles = None, 0, 0
+
+    def __call__(self):
+      window = int(self.clock())
+      if window != self.window:
+        self.window, self.calls = window, 0
+      self.calls += 1
+      if self.calls > self.capacity:
+        self.throttles += 1
+        raise Throttled()
+
+  # started off a whole second, where the rounding of the refill used to stall acquire()
+  clock = FakeClock(1000.02)
+  limiter = AdaptiveRateLimiter(50, min_rate=1, increase_per_second=2, clock=clock, sleep=clock.sleep)
+  service = ThrottlingService(clock, capacity=5)
+  while clock() < 1060:
+    limiter.call(service, max_attempts=100)
+  congested_rate = limiter.rate
+  assert service.throttles and congested_rate < 15, (service.throttles, congested_rate)
+
+  service.capacity = float('inf')
+  while clock() < 1120:
+    limiter.call(service)
+  assert limiter.rate == limiter.max_rate, limiter.rate
+  print('rate at 5 TPS: {:.1f}, recovered to {:.1f}'.format(congested_rate, limiter.rate), limiter.stats())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Tag counts per time bucket, kept up to date with scripted upserts.
+
+There is one rollup document per (granularity, bucket start, tag):
+
+  {"granularity": "hour", "bucket_start": "2020-11-18T09:00:00Z", "tag": "Car", "count": 42}
+
+The counts of a batch are merged per document first, so a batch sends one
+`update` action per rollup document, however many images it had.
+"""
+
+import collections
+import datetime
+
+CREATED_AT_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+BUCKET_FORMATS = {
+  'minute': '%Y-%m-%dT%H:%M:00Z',
+  'hour': '%Y-%m-%dT%H:00:00Z',
+  'day': '%Y-%m-%dT00:00:00Z'
+}
+
+UPSERT_SCRIPT = 'ctx._source.count += params.count'
+
+
+def rollup_counts(docs, granularities):
+  """Return a Counter of (granularity, bucket_start, tag) over the `tags` of the documents."""
+  counts = collections.Counter()
+  for doc in docs:
+    created_at = datetime.datetime.strptime(doc['created_at'], CREATED_AT_FORMAT)
+    for granularity in granularities:
+      bucket_start = created_at.strftime(BUCKET_FORMATS[granularity])
+      for tag in doc['tags']:
+        counts[(granularity, bucket_start, tag)] += 1
+  return counts
+
+
+def rollup_actions(counts, index, retry_on_conflict=5):
+  """Return the bulk `update` actions that add the counts to the rollup documents."""
+  actions = []
+  for (granularity, bucket_start, tag), count in sorted(counts.items()):
+    action_meta = {'update': {
+      '_index': index,
+      '_id': '{}|{}|{}'.format(granularity, bucket_start, tag),
+      # concurrent batches of other shards update the same documents
+      'retry_on_conflict': retry_on_conflict
+    }}
+    source = {
+      'script': {'source': UPSERT_SCRIPT, 'lang': 'painless', 'params': {'count': count}},
+      'upsert': {'granularity': granularity, 'bucket_start': bucket_start, 'tag': tag, 'count': count}
+    }
+    actions.append((action_meta, source))
+  return actions
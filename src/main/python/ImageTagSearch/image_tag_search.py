@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import json
+import os
+import re
+import threading
+import time
+import traceback
+
+import boto3
+
+from emf_metrics import StageMetrics
+from es_client import create_es_client
+from query_cache import QueryCache
+
+AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
+
+ES_INDEX = os.getenv('ES_INDEX', 'image_insights')
+ES_HOST = os.getenv('ES_HOST')
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'ImageInsights')
+
+#XXX: set QUERY_CACHE_SIZE=0 to disable the cache
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '256'))
+QUERY_CACHE_TTL_SECONDS = int(os.getenv('QUERY_CACHE_TTL_SECONDS', '60'))
+#XXX: the index generation (from the index stats) is read at most once per this many seconds
+GENERATION_CHECK_SECONDS = float(os.getenv('GENERATION_CHECK_SECONDS', '5'))
+
+# the generation while the index stats can not be read
+TTL_ONLY_GENERATION = 'ttl-only'
+
+MAX_PAGE_SIZE = 100
+MAX_RESULT_WINDOW = 10000
+
+SINCE_RE = re.compile(r'^[1-9][0-9]*[mhdwMy]$')
+
+session = boto3.Session(region_name=AWS_REGION)
+
+metrics = StageMetrics(METRICS_NAMESPACE, 'ImageTagSearch')
+
+# lives as long as the execution environment, so warm invocations share it
+query_cache = QueryCache(max_size=QUERY_CACHE_SIZE, ttl_seconds=QUERY_CACHE_TTL_SECONDS)
+
+_es_client = None
+_es_client_lock = threading.Lock()
+_generation = None
+_generation_checked_at = None
+
+
+def _get_es_client():
+  global _es_client
+
+  if _es_client is None:
+    with _es_client_lock:
+      if _es_client is None:
+        _es_client = create_es_client(ES_HOST, session, AWS_REGION)
+  return _es_client
+
+
+class BadRequestError(Exception):
+  """The query parameters are invalid."""
+
+
+def _split_tags(value):
+  return sorted({tag.strip() for tag in (value or '').split(',') if tag.strip()})
+
+
+def _int_param(params, name, default, lo, hi):
+  value = params.get(name)
+  if value in (None, ''):
+    return default
+  try:
+    value = int(value)
+  except ValueError:
+    raise BadRequestError('{} must be an integer'.format(name))
+  if not lo <= value <= hi:
+    raise BadRequestError('{} must be between {} and {}'.format(name, lo, hi))
+  return value
+
+
+def _since_param(params):
+  since = params.get('since') or None
+  if since is not None and not SINCE_RE.match(since):
+    raise BadRequestError('since must look like 30m, 12h, 7d, 4w, 6M or 1y')
+  return since
+
+
+def normalize_query(kind, params):
+  """Return the canonical form of the query, so that equivalent requests share a cache entry.
+
+  `tags` are deduplicated and sorted, defaults are filled in and `since` is
+  rounded to the hour when the query is built.
+  """
+  tags = _split_tags(params.get('tags'))
+  since = _since_param(params)
+  if kind == 'search':
+    match = params.get('match') or 'all'
+    if match not in ('all', 'any'):
+      raise BadRequestError('match must be all or any')
+    size = _int_param(params, 'size', 20, 1, MAX_PAGE_SIZE)
+    return {
+      'kind': kind,
+      'tags': tags,
+      'match': match if len(tags) > 1 else 'all',
+      'since': since,
+      'size': size,
+      'from': _int_param(params, 'from', 0, 0, MAX_RESULT_WINDOW - size)
+    }
+  if kind == 'top_tags':
+    return {
+      'kind': kind,
+      'tags': tags,
+      'since': since,
+      'size': _int_param(params, 'size', 10, 1, MAX_PAGE_SIZE)
+    }
+  raise ValueError(kind)
+
+
+def _filters(query):
+  filters = []
+  if query['tags'] and query.get('match') == 'any':
+    filters.append({'terms': {'tags': query['tags']}})
+  else:
+    filters.extend({'term': {'tags': tag}} for tag in query['tags'])
+  if query['since']:
+    # rounded, so that the shard request cache can serve it for the rest of the hour
+    filters.append({'range': {'created_at': {'gte': 'now-{}/h'.format(query['since'])}}})
+  return {'bool': {'filter': filters}}
+
+
+def build_request(query):
+  if query['kind'] == 'search':
+    return {
+      'query': _filters(query),
+      'sort': [{'created_at': {'order': 'desc'}}],
+      'size': query['size'],
+      'from': query['from'],
+      '_source': ['image_id', 'image_url', 'tags', 'created_at'],
+      'track_total_hits': True
+    }
+  # the tags that co-occur with `tags`, or the top tags overall
+  return {
+    'query': _filters(query),
+    'size': 0,
+    'aggs': {'top_tags': {'terms': {'field': 'tags', 'size': query['size'] + len(query['tags'])}}}
+  }
+
+
+def parse_response(query, response):
+  if query['kind'] == 'search':
+    return {
+      'total': response['hits']['total']['value'],
+      'images': [hit['_source'] for hit in response['hits']['hits']]
+    }
+  buckets = [bucket for bucket in response['aggregations']['top_tags']['buckets']
+    if bucket['key'] not in query['tags']]
+  return {
+    'total': response['hits']['total']['value'],
+    'tags': [{'tag': bucket['key'], 'count': bucket['doc_count']} for bucket in buckets[:query['size']]]
+  }
+
+
+def index_generation():
+  """Return a value that changes whenever documents are written to, or deleted from, the index.
+
+  Read from the primaries' indexing counters and the number of indices behind the alias.
+  """
+  global _generation, _generation_checked_at
+
+  now = time.monotonic()
+  if _generation is None or now - _generation_checked_at >= GENERATION_CHECK_SECONDS:
+    try:
+      with metrics.timer('index_stats'):
+        stats = _get_es_client().indices.stats(index=ES_INDEX, metric='docs,indexing')
+      primaries = stats['_all']['primaries']
+      _generation = '{}:{}:{}:{}'.format(len(stats.get('indices', {})),
+        primaries['indexing']['index_total'], primaries['indexing']['delete_total'], primaries['docs']['count'])
+    except Exception as ex:
+      # e.g. the role lacks indices_monitor: the results are then only cached for QUERY_CACHE_TTL_SECONDS
+      if _generation != TTL_ONLY_GENERATION:
+        print('[WARN] failed to read the index stats of {}, caching by TTL only: {}'.format(ES_INDEX, ex), file=sys.stderr)
+      _generation = TTL_ONLY_GENERATION
+    _generation_checked_at = now
+  return _generation
+
+
+def run_query(query):
+  """Return (result, cache_hit) of the normalized query."""
+  generation = index_generation()
+  cache_key = json.dumps(query, sort_keys=True)
+  result = query_cache.get(generation, cache_key)
+  if result is not None:
+    return (result, True)
+
+  with metrics.timer('search_backend'):
+    response = _get_es_client().search(index=ES_INDEX, body=build_request(query),
+      request_cache=query['kind'] == 'top_tags')
+  result = parse_response(query, response)
+  query_cache.put(generation, cache_key, result)
+  return (result, False)
+
+
+def _response(status_code, body, cache_status=None):
+  headers = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*'
+  }
+  if cache_status:
+    headers['X-Cache'] = cache_status
+  return {'statusCode': status_code, 'headers': headers, 'body': json.dumps(body, ensure_ascii=False)}
+
+
+ROUTES = {
+  '/_search/tags': 'search',
+  '/_search/top-tags': 'top_tags'
+}
+
+
+def lambda_handler(event, context):
+  """API Gateway proxy integration of
+
+    GET /_search/tags?tags=Car,Person&match=all|any&since=7d&size=20&from=0
+    GET /_search/top-tags?tags=Car&since=7d&size=10
+  """
+  kind = ROUTES.get(event.get('resource') or event.get('path'))
+  if kind is None:
+    return _response(404, {'message': 'Not Found'})
+
+  try:
+    query = normalize_query(kind, event.get('queryStringParameters') or {})
+    result, cache_hit = run_query(query)
+  except BadRequestError as ex:
+    return _response(400, {'message': str(ex)})
+  except Exception as ex:
+    traceback.print_exc()
+    metrics.add_error('query', ex)
+    metrics.flush()
+    return _response(502, {'message': 'search failed'})
+
+  metrics.put_metric('CacheHit', 1 if cache_hit else 0)
+  metrics.put_metric('CacheHitRatio', query_cache.stats()['hit_ratio'] * 100, 'Percent')
+  metrics.flush()
+  print('[INFO] query cache', json.dumps(query_cache.stats()), file=sys.stderr)
+  return _response(200, result, 'HIT' if cache_hit else 'MISS')
+
+
+if __name__ == '__main__':
+  event = {
+    'resource': '/_search/top-tags',
+    'httpMethod': 'GET',
+    'queryStringParameters': {'tags': 'Car', 'since': '7d'}
+  }
+  print(lambda_handler(event, {}))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+  """Thread-safe TTL + LRU cache of query results for one index generation.
+
+  Results are only reused while the index generation they were read at is
+  current: a new generation drops every entry at once, so nothing has to
+  track which queries a write could have changed. The TTL bounds how stale
+  a result can get between two generation checks.
+  """
+
+  def __init__(self, max_size=256, ttl_seconds=60, clock=time.monotonic):
+    self.max_size = max_size
+    self.ttl_seconds = ttl_seconds
+    self._clock = clock
+    self._items = OrderedDict()
+    self._generation = None
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+
+  def _set_generation(self, generation):
+    if generation != self._generation:
+      if self._items:
+        self.invalidations += 1
+      self._items.clear()
+      self._generation = generation
+
+  def get(self, generation, key):
+    with self._lock:
+      self._set_generation(generation)
+      item = self._items.get(key)
+      if item is not None and item[0] <= self._clock():
+        del self._items[key]
+        item = None
+      if item is None:
+        self.misses += 1
+        return None
+      self._items.move_to_end(key)
+      self.hits += 1
+      return item[1]
+
+  def put(self, generation, key, value):
+    if self.max_size <= 0:
+      return
+    with self._lock:
+      self._set_generation(generation)
+      self._items[key] = (self._clock() + self.ttl_seconds, value)
+      self._items.move_to_end(key)
+      while len(self._items) > self.max_size:
+        self._items.popitem(last=False)
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'invalidations': self.invalidations,
+      'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+      'size': len(self._items)
+    }
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+"""Rebuild the image index, e.g. after a change of its mappings or number of shards.
+
+  $ python src/main/python/Reindex/reindex.py --host vpc-image-insights-xxxx.us-east-1.es.amazonaws.com \\
+      --alias image_insights --shards 2 --slices 4 --swap
+  $ python src/main/python/Reindex/reindex.py --host http://localhost:9200 --transform my_transforms:drop_boxes
+
+The documents behind --alias are read with a sliced scroll, one worker per slice,
+passed through --transform if given (`module:function`, called with the `_source` of
+a document and returning the document to write, or None to drop it), and written
+with the bulk indexer into a new index `<alias>-<date>-<generation>`. The index
+template is updated first, so the new index gets the current mappings and --shards;
+it is loaded without replicas nor refresh, which are restored at the end.
+--shards, --replicas and --refresh-interval default to those of the current template.
+The image tagger puts the template again with its INDEX_SHARDS and INDEX_REPLICAS,
+and creates the indices of later rollovers with them: change those in the stack too.
+
+The bulk requests of all the workers share an AIMD rate limit, lowered whenever bulk
+items are rejected with 429 or a node queues more than --max-write-queue write requests.
+With --swap, the alias is moved to the new index in one request once every document
+was copied.
+
+Documents written through the alias while this runs are not copied: disable the
+Kinesis event source mapping of the image tagger meanwhile, the stream keeps the records.
+"""
+
+import argparse
+import concurrent.futures
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for _dir in (os.path.join('CommonLib', 'python'), 'ImageAutoTagger'):
+  sys.path.insert(0, os.path.join(SRC_DIR, _dir))
+
+import index_bootstrap
+from bulk_indexer import BulkIndexer
+from rate_limiter import AdaptiveRateLimiter
+
+MAX_FAILURES_LOGGED = 10
+
+
+def connect(host, region):
+  """Return a client of a local cluster (an http(s):// URL), or of an Amazon OpenSearch domain signed with SigV4."""
+  if host.startswith(('http://', 'https://')):
+    from elasticsearch import Elasticsearch
+    return Elasticsearch([host], timeout=60)
+
+  import boto3
+  from es_client import create_es_client
+  return create_es_client(host, boto3.Session(region_name=region), region, timeout=60)
+
+
+def load_transform(spec):
+  """Return the function of a `module:function` spec, importable from the current directory."""
+  module_name, _, function_name = spec.partition(':')
+  sys.path.insert(0, os.getcwd())
+  return getattr(importlib.import_module(module_name), function_name or 'transform')
+
+
+def scroll_slice(es_client, index, slice_id, slices, page_size=1000, scroll='5m'):
+  """Yield the hits of one slice of the index, a page at a time."""
+  body = {'query': {'match_all': {}}, 'sort': ['_doc']}
+  if slices > 1:
+    body['slice'] = {'id': slice_id, 'max': slices}
+  response = es_client.search(index=index, scroll=scroll, size=page_size, body=body)
+  scroll_id = response.get('_scroll_id')
+  try:
+    while response['hits']['hits']:
+      yield response['hits']['hits']
+      response = es_client.scroll(scroll_id=scroll_id, scroll=scroll)
+      scroll_id = response.get('_scroll_id', scroll_id)
+  finally:
+    if scroll_id:
+      try:
+        es_client.clear_scroll(scroll_id=scroll_id)
+      except Exception:
+        pass
+
+
+def write_pressure(es_client):
+  """Return (largest queue, total rejections) of the write thread pools of the nodes."""
+  response = es_client.nodes.stats(metric='thread_pool', filter_path='nodes.*.thread_pool.write')
+  pools = [node['thread_pool']['write'] for node in response.get('nodes', {}).values()]
+  return (max([pool.get('queue', 0) for pool in pools] or [0]), sum(pool.get('rejected', 0) for pool in pools))
+
+
+class Reindexer:
+
+  def __init__(self, es_client, source, target, slices=4, page_size=1000, transform=None,
+      limiter=None, max_write_queue=50, pressure_check_seconds=5.0, progress_seconds=10.0,
+      clock=time.monotonic):
+    self.es_client = es_client
+    self.source = source
+    self.target = target
+    self.slices = slices
+    self.page_size = page_size
+    self.transform = transform
+    self.limiter = limiter or AdaptiveRateLimiter(1e6)
+    self.max_write_queue = max_write_queue
+    self.pressure_check_seconds = pressure_check_seconds
+    self.progress_seconds = progress_seconds
+    self._clock = clock
+    self._bulk_indexer = BulkIndexer(es_client, max_chunk_docs=page_size)
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self.stats = {'read': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'throttled': 0}
+
+  def _count(self, **counts):
+    with self._lock:
+      for name, count in counts.items():
+        self.stats[name] += count
+
+  def _copy_slice(self, slice_id):
+    for hits in scroll_slice(self.es_client, self.source, slice_id, self.slices, self.page_size):
+      if self._stop.is_set():
+        return
+      actions = []
+      for hit in hits:
+        doc = hit['_source'] if self.transform is None else self.transform(hit['_source'])
+        if doc is not None:
+          actions.append(({'index': {'_index': self.target, '_id': hit['_id']}}, doc))
+
+      if actions:
+        self.limiter.acquire()
+        result = self._bulk_indexer.index(actions)
+        if any(chunk['retried'] for chunk in result.chunks):
+          self.limiter.on_throttle()
+          self._count(throttled=1)
+        else:
+          self.limiter.on_success()
+        for failure in result.failed[:MAX_FAILURES_LOGGED]:
+          print('[ERROR] failed to index', actions[failure['index']][0]['index']['_id'],
+            failure['status'], json.dumps(failure['error']), file=sys.stderr)
+      else:
+        result = None
+      self._count(read=len(hits), dropped=len(hits) - len(actions),
+        written=result.succeeded if result else 0, failed=len(result.failed) if result else 0)
+
+  def _watch_pressure(self):
+    last_rejected = None
+    while not self._stop.wait(self.pressure_check_seconds):
+      try:
+        queued, rejected = write_pressure(self.es_client)
+      except Exception as ex:
+        print('[WARN] failed to read the thread pool stats: {!r}'.format(ex), file=sys.stderr)
+        continue
+      if queued > self.max_write_queue or (last_rejected is not None and rejected > last_rejected):
+        self.limiter.on_throttle()
+        self._count(throttled=1)
+      last_rejected = rejected
+
+  def progress(self, elapsed):
+    with self._lock:
+      stats = dict(self.stats)
+    return dict(stats, elapsed_seconds=round(elapsed, 1),
+      docs_per_sec=round(stats['written'] / elapsed, 1) if elapsed else 0.0,
+      bulk_rate_limit=round(self.limiter.rate, 2))
+
+  def run(self):
+    """Copy every slice and return the summary; raises the first error of a slice."""
+    started_at = self._clock()
+    watcher = threading.Thread(target=self._watch_pressure, daemon=True)
+    watcher.start()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.slices)
+    try:
+      pending = {executor.submit(self._copy_slice, slice_id) for slice_id in range(self.slices)}
+      while pending:
+        done, pending = concurrent.futures.wait(pending, timeout=self.progress_seconds,
+          return_when=concurrent.futures.FIRST_EXCEPTION)
+        for future in done:
+          future.result()
+        print('[INFO] progress', json.dumps(self.progress(self._clock() - started_at)), file=sys.stderr)
+    finally:
+      self._stop.set()
+      executor.shutdown(wait=True)
+    return self.progress(self._clock() - started_at)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--host', required=True, help='endpoint of the OpenSearch domain, or the URL of a local cluster')
+  parser.add_argument('--region', default=os.getenv('REGION_NAME', 'us-east-1'))
+  parser.add_argument('--alias', default='image_insights', help='write alias (or index) to rebuild')
+  parser.add_argument('--target', help='name of the new index, by default the next generation of the alias')
+  parser.add_argument('--shards', type=int, help='by default those of the index template')
+  parser.add_argument('--replicas', type=int, help='by default those of the index template')
+  parser.add_argument('--refresh-interval', help='by default that of the index template')
+  parser.add_argument('--slices', type=int, default=4, help='sliced scroll workers')
+  parser.add_argument('--page-size', type=int, default=1000, help='documents per scroll page and bulk request')
+  parser.add_argument('--transform', metavar='MODULE:FUNCTION')
+  parser.add_argument('--max-bulk-per-sec', type=float, default=20.0, help='upper limit of the bulk requests/s of all the workers')
+  parser.add_argument('--max-write-queue', type=int, default=50, help='write requests queued on a node before slowing down')
+  parser.add_argument('--progress-seconds', type=float, default=10.0)
+  parser.add_argument('--swap', action='store_true', help='point the alias at the new index at the end')
+  parser.add_argument('--replace-index', action='store_true', help='with --swap, delete --alias if it is a concrete index')
+  parser.add_argument('--force', action='store_true', help='swap even if some documents failed')
+  options = parser.parse_args()
+
+  es_client = connect(options.host, options.region)
+  if options.swap and not options.replace_index and not es_client.indices.exists_alias(name=options.alias) \
+      and es_client.indices.exists(index=options.alias):
+    parser.error('{} is an index, not an alias: add --replace-index to replace it by the alias'.format(options.alias))
+  transform = load_transform(options.transform) if options.transform else None
+
+  template_settings = index_bootstrap.get_index_template_settings(es_client, options.alias) or {}
+  for option, setting in (('shards', 'number_of_shards'), ('replicas', 'number_of_replicas')):
+    if getattr(options, option) is None:
+      if setting not in template_settings:
+        parser.error('the index template {} has no {}: give --{}'.format(options.alias, setting, option))
+      setattr(options, option, int(template_settings[setting]))
+  if options.refresh_interval is None:
+    options.refresh_interval = template_settings.get('refresh_interval', '30s')
+  print('[INFO] shards: {}, replicas: {}, refresh interval: {}'.format(options.shards, options.replicas,
+    options.refresh_interval), file=sys.stderr)
+
+  index_bootstrap.put_index_template(es_client, options.alias, number_of_shards=options.shards,
+    number_of_replicas=options.replicas, refresh_interval=options.refresh_interval)
+  target = options.target or index_bootstrap.next_index_name(es_client, options.alias, time.strftime('%Y.%m.%d', time.gmtime()))
+  # loaded faster without replicas and refreshes; set back once loaded
+  es_client.indices.create(index=target, body={'settings': {'index': {'number_of_replicas': 0, 'refresh_interval': '-1'}}})
+  source_count = es_client.count(index=options.alias)['count']
+  print('[INFO] reindexing {} documents of {} into {}'.format(source_count, options.alias, target), file=sys.stderr)
+
+  limiter = AdaptiveRateLimiter(options.max_bulk_per_sec, min_rate=0.5, increase_per_second=0.5)
+  reindexer = Reindexer(es_client, options.alias, target, slices=options.slices, page_size=options.page_size,
+    transform=transform, limiter=limiter, max_write_queue=options.max_write_queue,
+    progress_seconds=options.progress_seconds)
+  summary = reindexer.run()
+
+  es_client.indices.put_settings(index=target, body={'index': {'number_of_replicas': options.replicas,
+    'refresh_interval': options.refresh_interval}})
+  es_client.indices.refresh(index=target)
+  summary.update({'source': options.alias, 'target': target, 'source_count': source_count,
+    'target_count': es_client.count(index=target)['count'], 'swapped': False})
+
+  if options.swap:
+    if summary['failed'] and not options.force:
+      print('[ERROR] {} documents failed, the alias is left as it is (see --force)'.format(summary['failed']), file=sys.stderr)
+    else:
+      old_indices = index_bootstrap.swap_alias(es_client, options.alias, target, replace_index=options.replace_index)
+      summary['swapped'] = True
+      if old_indices:
+        print('[INFO] {} moved to {} from {}; delete those once {} is verified'.format(
+          options.alias, target, ', '.join(old_indices), target), file=sys.stderr)
+  print(json.dumps(summary))
+  if summary['failed'] and not summary['swapped']:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
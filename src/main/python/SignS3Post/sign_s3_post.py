@@ -11,6 +11,7 @@
 #***************************************************************************************/
 
 import base64
+import functools
 import hashlib
 import hmac
 import json
@@ -29,6 +30,21 @@ else:
 ACCESS_KEY = os.environ.get('ACCESS_KEY')
 SECRET_KEY = os.environ.get('SECRET_KEY')
 
+#XXX: upper limit of the policies/header sets signed by one batch request
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '500'))
+
+#XXX: multipart uploads are started in these buckets only; empty allows any bucket the keys can write to
+ALLOWED_BUCKETS = [bucket.strip() for bucket in os.environ.get('ALLOWED_BUCKETS', '').split(',') if bucket.strip()]
+#XXX: and only for keys under this prefix, where the image tagger picks them up
+ALLOWED_KEY_PREFIX = os.environ.get('ALLOWED_KEY_PREFIX', 'raw-image/')
+PRESIGNED_URL_EXPIRES_IN = int(os.environ.get('PRESIGNED_URL_EXPIRES_IN', '3600'))
+#XXX: only for a local S3 stand-in
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+
+MAX_PART_NUMBER = 10000
+
+_s3_client = None
+
 
 # Key derivation functions. See:
 # http://docs.aws.amazon.com/general/latest/gr/signature-v4-examples.html#signature-v4-examples-python
@@ -36,6 +52,9 @@ def sign(key, msg):
   return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
 
 
+# the derived key only changes with the date, region and service, so warm invocations
+# and the items of a batch reuse it instead of chaining four HMACs per signature
+@functools.lru_cache(maxsize=32)
 def getSignatureKey(key, date_stamp, regionName, serviceName):
   kDate = sign(('AWS4' + key).encode('utf-8'), date_stamp)
   kRegion = sign(kDate, regionName)
@@ -81,17 +100,164 @@ def sign_headers(headers):
   return {'signature': signature}
 
 
+def sign_request(request_payload):
+  """ Sign one policy document or set of REST headers. """
+  if request_payload.get('headers'):
+    return sign_headers(request_payload['headers'])
+  credential = list([c for c in request_payload['conditions'] if 'x-amz-credential' in c][0].values())[0]
+  return sign_policy(json.dumps(request_payload).encode('utf-8'), str(credential))
+
+
+def sign_batch(request_payloads):
+  """ Sign every item of a batch; an item that can not be signed gets an error instead. """
+  results = []
+  for request_payload in request_payloads:
+    try:
+      results.append(sign_request(request_payload))
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError) as ex:
+      results.append({'error': '{}: {}'.format(type(ex).__name__, ex)})
+  return results
+
+
+def _get_s3_client():
+  global _s3_client
+
+  if _s3_client is None:
+    # imported on first use, so that a cold start of the policy signing does not pay for it
+    import boto3
+    from botocore.config import Config
+
+    _s3_client = boto3.client('s3',
+      aws_access_key_id=ACCESS_KEY,
+      aws_secret_access_key=SECRET_KEY,
+      endpoint_url=S3_ENDPOINT_URL,
+      config=Config(signature_version='s3v4'))
+  return _s3_client
+
+
+class BadRequestError(ValueError):
+
+  def __init__(self, message):
+    # mapped to 400 by the integration response of the API
+    super().__init__('[BadRequest] ' + message)
+
+
+def _upload_target(request):
+  try:
+    bucket, key = request['bucket'], request['key']
+  except (KeyError, TypeError):
+    raise BadRequestError('bucket and key are required')
+  if ALLOWED_BUCKETS and bucket not in ALLOWED_BUCKETS:
+    raise BadRequestError('bucket {} is not allowed'.format(bucket))
+  if not isinstance(key, str) or not key.startswith(ALLOWED_KEY_PREFIX) or len(key) == len(ALLOWED_KEY_PREFIX):
+    raise BadRequestError('key must start with {}'.format(ALLOWED_KEY_PREFIX))
+  # a client would resolve them in the presigned URL, out of the prefix
+  if any(segment in ('.', '..') for segment in key.split('/')):
+    raise BadRequestError('key must not have . or .. segments')
+  return bucket, key
+
+
+def _upload_id(request):
+  if not request.get('upload_id'):
+    raise BadRequestError('upload_id is required')
+  return request['upload_id']
+
+
+def _part_numbers(request):
+  part_numbers = request.get('part_numbers')
+  if part_numbers is None:
+    part_numbers = list(range(1, int(request.get('parts') or 0) + 1))
+  if not part_numbers or len(part_numbers) > MAX_BATCH_SIZE:
+    raise BadRequestError('between 1 and {} parts can be signed at once'.format(MAX_BATCH_SIZE))
+  if any(not isinstance(n, int) or not 1 <= n <= MAX_PART_NUMBER for n in part_numbers):
+    raise BadRequestError('part numbers must be between 1 and {}'.format(MAX_PART_NUMBER))
+  return part_numbers
+
+
+def _presign_parts(bucket, key, upload_id, part_numbers):
+  # presigning is computed locally, so signing many parts costs no request to S3
+  s3_client = _get_s3_client()
+  return [{
+    'part_number': part_number,
+    'url': s3_client.generate_presigned_url('upload_part',
+      Params={'Bucket': bucket, 'Key': key, 'UploadId': upload_id, 'PartNumber': part_number},
+      ExpiresIn=PRESIGNED_URL_EXPIRES_IN)
+  } for part_number in part_numbers]
+
+
+def initiate_multipart_upload(request):
+  """ Start a multipart upload, and sign its first `parts` parts if given. """
+  bucket, key = _upload_target(request)
+  params = {'ContentType': request['content_type']} if request.get('content_type') else {}
+  response = _get_s3_client().create_multipart_upload(Bucket=bucket, Key=key, **params)
+  result = {'bucket': bucket, 'key': key, 'upload_id': response['UploadId']}
+  if request.get('parts') or request.get('part_numbers'):
+    result['parts'] = _presign_parts(bucket, key, result['upload_id'], _part_numbers(request))
+  return result
+
+
+def sign_upload_parts(request):
+  """ Return presigned PUT URLs of the `part_numbers` (or the first `parts`) parts. """
+  bucket, key = _upload_target(request)
+  return {'parts': _presign_parts(bucket, key, _upload_id(request), _part_numbers(request))}
+
+
+def complete_multipart_upload(request):
+  """ Complete the upload from the ETags the part uploads returned. """
+  bucket, key = _upload_target(request)
+  try:
+    parts = sorted({part['part_number']: part['etag'] for part in request['parts']}.items())
+  except (KeyError, TypeError):
+    raise BadRequestError('parts must be a list of {"part_number", "etag"}')
+  response = _get_s3_client().complete_multipart_upload(Bucket=bucket, Key=key,
+    UploadId=_upload_id(request),
+    MultipartUpload={'Parts': [{'PartNumber': part_number, 'ETag': etag} for part_number, etag in parts]})
+  return {'bucket': bucket, 'key': key, 'etag': response['ETag'], 'location': response.get('Location')}
+
+
+def abort_multipart_upload(request):
+  bucket, key = _upload_target(request)
+  _get_s3_client().abort_multipart_upload(Bucket=bucket, Key=key, UploadId=_upload_id(request))
+  return {'bucket': bucket, 'key': key, 'aborted': True}
+
+
+MULTIPART_ACTIONS = {
+  'initiate': initiate_multipart_upload,
+  'sign-parts': sign_upload_parts,
+  'complete': complete_multipart_upload,
+  'abort': abort_multipart_upload
+}
+
+
 def lambda_handler(event, context):
-  """ Route for signing the policy document or REST headers. """
+  """ Route for signing the policy document or REST headers.
 
-  logger.info('event: %s' % event)
-  request_payload = event
-  if request_payload.get('headers'):
-    response_data = sign_headers(request_payload['headers'])
-  else:
-    credential = list([c for c in request_payload['conditions'] if 'x-amz-credential' in c][0].values())[0]
-    logger.info('credential=%s, data_type=%s' % (credential, type(credential)))
-    response_data = sign_policy(json.dumps(event).encode('utf-8'), str(credential))
+  A batch request `{"batch": [<policy document or {"headers": ...}>, ...]}`
+  signs up to MAX_BATCH_SIZE items at once and returns `{"signatures": [...]}`
+  in the same order.
+
+  The multipart routes of the API send `{"multipart_action": <action>, "body": <request>}`
+  with one of the MULTIPART_ACTIONS.
+  """
+  logger.debug('event: %s', event)
+  if 'multipart_action' in event:
+    action = MULTIPART_ACTIONS.get(event['multipart_action'])
+    if action is None:
+      raise BadRequestError('unknown multipart action {}'.format(event['multipart_action']))
+    response_data = action(event.get('body') or {})
+    logger.info('multipart %s: s3://%s/%s', event['multipart_action'], response_data['bucket'], response_data['key'])
+    return response_data
+
+  if 'batch' in event:
+    if len(event['batch']) > MAX_BATCH_SIZE:
+      raise ValueError('batch of {} items is larger than {}'.format(len(event['batch']), MAX_BATCH_SIZE))
+    signatures = sign_batch(event['batch'])
+    failed = sum(1 for signature in signatures if 'error' in signature)
+    logger.info('signed batch: items=%d, failed=%d', len(signatures), failed)
+    return {'signatures': signatures}
+
+  response_data = sign_request(event)
+  logger.info('signed %s', 'headers' if event.get('headers') else 'policy')
   return response_data
 
 
@@ -117,3 +283,6 @@ if __name__ == '__main__':
   res = lambda_handler(event, {})
   pprint.pprint(res)
 
+  res = lambda_handler({'batch': [event, {'conditions': []}]}, {})
+  pprint.pprint(res)
+
@@ -5,60 +5,212 @@
 import sys
 import json
 import os
+import hashlib
+import random
+import time
 import urllib.parse
 import traceback
 import datetime
 
 import boto3
 
+from dead_letter import (
+  create_spool,
+  dead_letter_entry,
+  write_dead_letters
+)
+from emf_metrics import (
+  StageMetrics,
+  should_log_verbose
+)
+import json_codec
+from kpl_aggregation import (
+  RecordAggregator,
+  DEFAULT_MAX_AGGREGATED_SIZE
+)
+
+#XXX: log the records instead of writing them into the stream
 DRY_RUN = (os.getenv('DRY_RUN', 'false') == 'true')
 
 AWS_REGION = os.getenv('REGION_NAME', 'us-east-1')
 KINESIS_STREAM_NAME = os.getenv('KINESIS_STREAM_NAME', 'november-photo')
 
+#XXX: pack the messages into KPL aggregated records; the image tagger de-aggregates them
+KPL_AGGREGATION = (os.getenv('KPL_AGGREGATION', 'true') == 'true')
+KPL_MAX_AGGREGATED_SIZE = int(os.getenv('KPL_MAX_AGGREGATED_SIZE', str(DEFAULT_MAX_AGGREGATED_SIZE)))
 
-def write_records_to_kinesis(kinesis_client, kinesis_stream_name, records):
-  import random
-  random.seed(47)
+# limits of a PutRecords request
+MAX_PUT_RECORDS_COUNT = 500
+MAX_PUT_RECORDS_BYTES = 5 * 1024 * 1024
 
-  def gen_records():
-    record_list = []
-    for rec in records:
-      payload = json.dumps(rec, ensure_ascii=False)
-      partition_key = 'part-{:05}'.format(random.randint(1, 1024))
-      record_list.append({'Data': payload, 'PartitionKey': partition_key})
-    return record_list
+#XXX: aggregated records only pack messages of the same slice of the hash key space,
+# and are routed to the middle of it, so that messages of an object always go to the same shard
+KINESIS_HASH_KEY_SLICES = int(os.getenv('KINESIS_HASH_KEY_SLICES', '256'))
+HASH_KEY_SPACE = 2 ** 128
 
-  MAX_RETRY_COUNT = 3
+KINESIS_MAX_ATTEMPTS = int(os.getenv('KINESIS_MAX_ATTEMPTS', '5'))
+KINESIS_INITIAL_BACKOFF, KINESIS_MAX_BACKOFF = (0.1, 5.0)
 
-  record_list = gen_records()
-  for _ in range(MAX_RETRY_COUNT):
-    try:
-      response = kinesis_client.put_records(Records=record_list, StreamName=kinesis_stream_name)
-      print("[DEBUG] try to write_records_to_kinesis", response, file=sys.stderr)
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'ImageInsights')
+
+#XXX: SQS queue URL, s3://bucket/prefix/ or local directory of the records that could not be sent on
+DEAD_LETTER_SPOOL = os.getenv('DEAD_LETTER_SPOOL')
+
+metrics = StageMetrics(METRICS_NAMESPACE, 'TriggerImageAutoTagger')
+
+# reused by warm invocations instead of being created for every event
+kinesis_client = boto3.client('kinesis', region_name=AWS_REGION)
+
+dead_letter_spool = create_spool(DEAD_LETTER_SPOOL, boto3.Session(region_name=AWS_REGION))
+
+
+def partition_key(rec):
+  """Return a stable partition key of the object, so that its messages stay in order on one shard."""
+  object_path = '{}/{}'.format(rec['s3_bucket'], rec['s3_key'])
+  return hashlib.md5(object_path.encode('utf-8')).hexdigest()
+
+
+def _hash_key_slice(partition_key, slices=KINESIS_HASH_KEY_SLICES):
+  """Return the slice of the hash key space that Kinesis maps the partition key to (by its MD5)."""
+  hash_key = int(hashlib.md5(partition_key.encode('utf-8')).hexdigest(), 16)
+  return hash_key * slices // HASH_KEY_SPACE
+
+
+def _explicit_hash_key(hash_key_slice, slices=KINESIS_HASH_KEY_SLICES):
+  return str((2 * hash_key_slice + 1) * HASH_KEY_SPACE // (2 * slices))
+
+
+def _gen_entries(records, aggregation):
+  """Return the PutRecords entries for the records, each with the indexes of the records it carries."""
+  user_records = []
+  for rec in records:
+    user_records.append((partition_key(rec), json_codec.dumps(rec)))
+
+  if not aggregation:
+    return [({'Data': data, 'PartitionKey': key}, [i])
+      for i, (key, data) in enumerate(user_records)]
+
+  slices = {}
+  for i, (key, _) in enumerate(user_records):
+    slices.setdefault(_hash_key_slice(key), []).append(i)
+
+  entries = []
+  for hash_key_slice, record_indexes in slices.items():
+    explicit_hash_key = _explicit_hash_key(hash_key_slice)
+    aggregator = RecordAggregator(KPL_MAX_AGGREGATED_SIZE)
+    carried = []
+    for i in record_indexes:
+      finished = aggregator.add(*user_records[i])
+      if finished is not None:
+        entries.append(({'Data': finished[1], 'PartitionKey': finished[0], 'ExplicitHashKey': explicit_hash_key}, carried))
+        carried = []
+      carried.append(i)
+    last = aggregator.flush()
+    entries.append(({'Data': last[1], 'PartitionKey': last[0], 'ExplicitHashKey': explicit_hash_key}, carried))
+  return entries
+
+
+def _chunk_entries(entries):
+  """Split the entries into PutRecords requests within the record count and payload size limits."""
+  chunk, chunk_bytes = [], 0
+  for entry in entries:
+    record = entry[0]
+    size = len(record['Data']) + len(record['PartitionKey'].encode('utf-8'))
+    if chunk and (len(chunk) >= MAX_PUT_RECORDS_COUNT or chunk_bytes + size > MAX_PUT_RECORDS_BYTES):
+      yield chunk
+      chunk, chunk_bytes = [], 0
+    chunk.append(entry)
+    chunk_bytes += size
+  if chunk:
+    yield chunk
+
+
+def write_records_to_kinesis(kinesis_client, kinesis_stream_name, records,
+    aggregation=KPL_AGGREGATION, max_attempts=KINESIS_MAX_ATTEMPTS, sleep=time.sleep):
+  """Put the records into the stream with as few PutRecords calls as possible.
+
+  Only the entries that failed (per `FailedRecordCount`/`ErrorCode` of the response,
+  or all the entries of a call that raised) are sent again, with full-jitter
+  exponential backoff. Returns the records that could not be written after `max_attempts`.
+  """
+  pending = _gen_entries(records, aggregation)
+  for attempt in range(max_attempts):
+    if attempt > 0:
+      sleep(random.uniform(0, min(KINESIS_MAX_BACKOFF, KINESIS_INITIAL_BACKOFF * (2 ** attempt))))
+
+    retry = []
+    for chunk in _chunk_entries(pending):
+      try:
+        response = kinesis_client.put_records(Records=[record for record, _ in chunk], StreamName=kinesis_stream_name)
+      except Exception as ex:
+        traceback.print_exc()
+        retry.extend(chunk)
+        continue
+
+      if should_log_verbose():
+        print("[DEBUG] try to write_records_to_kinesis", response, file=sys.stderr)
+      if response.get('FailedRecordCount', 0) > 0:
+        retry.extend(entry for entry, result in zip(chunk, response['Records']) if 'ErrorCode' in result)
+
+    pending = retry
+    if not pending:
       break
-    except Exception as ex:
-      import time
 
-      traceback.print_exc()
-      time.sleep(2)
-  else:
-    raise RuntimeError('[ERROR] Failed to put_records into kinesis stream: {}'.format(kinesis_stream_name))
+  return [records[i] for _, record_indexes in pending for i in record_indexes]
 
 
-def lambda_handler(event, context):
-  kinesis_client = boto3.client('kinesis', region_name=AWS_REGION)
+def put_records(kinesis_client, kinesis_stream_name, records):
+  """`write_records_to_kinesis`, or only log the records if DRY_RUN is set."""
+  if DRY_RUN:
+    for record in records:
+      print('[INFO] dry run, not written into {}:'.format(kinesis_stream_name),
+        json.dumps(record, ensure_ascii=False), file=sys.stderr)
+    return []
+  return write_records_to_kinesis(kinesis_client, kinesis_stream_name, records)
 
+
+def lambda_handler(event, context):
+  records, dead_letters = [], []
   for record in event['Records']:
     try:
-      bucket = record['s3']['bucket']['name']
-      key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+      with metrics.timer('decode'):
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+        etag = record['s3']['object'].get('eTag')
+        size = record['s3']['object'].get('size')
 
       record = {'s3_bucket': bucket, 's3_key': key}
-      print("[INFO] object created: ", record, file=sys.stderr)
-      write_records_to_kinesis(kinesis_client, KINESIS_STREAM_NAME, [record])
+      if etag:
+        # lets the image tagger look up its label cache without a HeadObject call
+        record['s3_etag'] = etag
+      if size is not None:
+        # lets the image tagger skip the objects out of its size limits without fetching them
+        record['s3_size'] = size
+      if should_log_verbose():
+        print("[INFO] object created: ", record, file=sys.stderr)
+      records.append(record)
     except Exception as ex:
       traceback.print_exc()
+      dead_letters.append(dead_letter_entry('TriggerImageAutoTagger', 'decode', ex, raw=record))
+
+  # all the objects of the event go together, so that they can share aggregated records and requests
+  unwritten = []
+  if records:
+    with metrics.timer('kinesis_put'):
+      unwritten = put_records(kinesis_client, KINESIS_STREAM_NAME, records)
+    for record in unwritten:
+      print('[ERROR] Failed to put_records into kinesis stream: {}'.format(KINESIS_STREAM_NAME),
+        json.dumps(record, ensure_ascii=False), file=sys.stderr)
+    dead_letters.extend(dead_letter_entry('TriggerImageAutoTagger', 'kinesis_put',
+      'not written into {} after {} attempts'.format(KINESIS_STREAM_NAME, KINESIS_MAX_ATTEMPTS),
+      payload=record, error_class='PutRecordsFailed')
+      for record in unwritten)
+
+  write_dead_letters(dead_letter_spool, dead_letters)
+  metrics.put_metric('RecordsReceived', len(event['Records']))
+  metrics.put_metric('RecordsUnwritten', len(unwritten))
+  metrics.put_metric('DeadLetters', len(dead_letters))
+  metrics.flush()
 
 
 if __name__ == '__main__':